@@ -0,0 +1,43 @@
+"""Report the memory used per cons cell by a long Scheme list.
+
+Run from the scheme_stubbed directory or from here:
+
+    python3 bench/memory.py [--size N]
+"""
+
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scheme_reader import Pair, nil
+from ucb import main
+
+
+def bytes_per_cell(size):
+    """Build a SIZE-element Scheme list and return the bytes allocated for
+    each of its cons cells. The elements are created beforehand so that
+    only the cells are measured."""
+    elements = list(range(size))
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    lst = nil
+    for element in reversed(elements):
+        lst = Pair(element, lst)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / size
+
+
+@main
+def run(*argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='Measure bytes per cons cell')
+    parser.add_argument('--size', type=int, default=1000000,
+                        help='number of elements in the list')
+    args = parser.parse_args()
+
+    per_cell = bytes_per_cell(args.size)
+    print('{0} cells: {1:.1f} bytes per cell, {2:.1f} MB in all'.format(
+        args.size, per_cell, per_cell * args.size / 2 ** 20))
@@ -0,0 +1,206 @@
+"""Run the Scheme interpreter on the benchmark workloads, and compare the
+results with a baseline.
+
+Each workload is a Scheme file that scheme.py runs in a fresh process, from
+the repository root, so that startup is measured too and the homework files
+can be loaded by their paths. For each, the median wall time of several
+runs, the peak memory of a run, and the number of procedure calls made per
+second are recorded. Run from the scheme_stubbed directory or from here:
+
+    python3 bench/run.py --save-baseline          # Record bench/baseline.json
+    python3 bench/run.py                          # Compare with it
+    python3 bench/run.py --engine vm --only fib --output vm.json
+
+The exit status is 1 if a workload took longer than the baseline by more
+than the threshold, or if it printed a different number of errors than it
+should or than it did in the baseline. A workload that fails this way is not
+compared by time, since it may only have been fast because it stopped early,
+and the results are not saved as a baseline.
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(os.path.dirname(BENCH))
+SCHEME = os.path.join(ROOT, 'scheme_stubbed', 'scheme.py')
+BASELINE = os.path.join(BENCH, 'baseline.json')
+
+sys.path.insert(0, os.path.dirname(BENCH))
+
+from ucb import main
+
+WORKLOADS = [(name, os.path.join(BENCH, 'workloads', name + '.scm'))
+             for name in ('fib', 'tak', 'tail', 'sort', 'macros',
+                          'hw07', 'hw09', 'lab10')]
+WORKLOADS.append(('tests', os.path.join(ROOT, 'scheme_stubbed', 'tests.scm')))
+
+# The errors that each run of a workload prints, where it is not 0. tests.scm
+# checks that some errors are reported.
+EXPECTED_ERRORS = {'tests': 3}
+
+ENGINES = {'tree': [], 'analyze': ['--analyze'], 'vm': ['--vm']}
+
+
+def run_once(path, flags):
+    """Run scheme.py with FLAGS on the file at PATH, and return the seconds
+    it took, its peak resident memory in kilobytes, and its output."""
+    with tempfile.TemporaryFile('w+') as output:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, SCHEME] + flags + [path],
+                                   cwd=ROOT, stdin=subprocess.DEVNULL,
+                                   stdout=output, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        output.seek(0)
+        text = output.read()
+    if process.returncode != 0:
+        raise RuntimeError('{0} exited with status {1}:\n{2}'.format(
+            path, process.returncode, text[-2000:]))
+    return seconds, usage.ru_maxrss, text
+
+
+def count_calls(path, flags):
+    """Return the number of procedure calls made by running the file at PATH
+    with FLAGS, as counted by the profiler."""
+    handle, report = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+    try:
+        run_once(path, flags + ['--profile-json', report])
+        with open(report) as infile:
+            summary = json.load(infile)
+    finally:
+        os.unlink(report)
+    return sum(record['calls'] for record in summary['procedures'])
+
+
+def measure(path, flags, repeat, calls=True):
+    """Return a dict of the measurements of the workload at PATH."""
+    times, peak, errors = [], 0, 0
+    for _ in range(repeat):
+        seconds, memory, text = run_once(path, flags)
+        times.append(seconds)
+        peak = max(peak, memory)
+        errors += sum(line.startswith('Error:') for line in text.splitlines())
+    median = statistics.median(times)
+    result = {'median': median, 'times': times, 'peak_kb': peak,
+              'errors': errors}
+    if calls:
+        result['calls'] = count_calls(path, flags)
+        result['calls_per_second'] = result['calls'] / median
+    return result
+
+
+def errors_per_run(results, name):
+    """Return the errors that each run of the workload NAME in RESULTS
+    printed, on average."""
+    return results['workloads'][name]['errors'] / results['repeat']
+
+
+def failures(results, baseline=None):
+    """Return the names of the workloads in RESULTS that printed a different
+    number of errors per run than they should, or than in BASELINE."""
+    failed = []
+    for name in results['workloads']:
+        errors = errors_per_run(results, name)
+        if errors != EXPECTED_ERRORS.get(name, 0):
+            failed.append(name)
+        elif (baseline is not None and name in baseline['workloads'] and
+                errors != errors_per_run(baseline, name)):
+            failed.append(name)
+    return failed
+
+
+def compare(results, baseline, threshold):
+    """Print the median times of RESULTS against those of BASELINE, and
+    return the names of the workloads that are slower by more than the
+    fraction THRESHOLD, or that failed."""
+    regressions = []
+    failed = failures(results, baseline)
+    print('{0:<10} {1:>10} {2:>10} {3:>8} {4:>10}'.format(
+        'workload', 'baseline', 'median', 'ratio', 'peak KB'))
+    for name, result in results['workloads'].items():
+        base = baseline['workloads'].get(name)
+        if name in failed:
+            regressions.append(name)
+            print('{0:<10} {1:>10} {2:>10} {3:>8} {4:>10}  {5:g} errors'.format(
+                name, '-', '-', '-', result['peak_kb'],
+                errors_per_run(results, name)))
+            continue
+        if base is None:
+            print('{0:<10} {1:>10} {2:>10.3f} {3:>8} {4:>10}'.format(
+                name, '-', result['median'], '-', result['peak_kb']))
+            continue
+        ratio = result['median'] / base['median']
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = '  slower'
+        print('{0:<10} {1:>10.3f} {2:>10.3f} {3:>8.2f} {4:>10}{5}'.format(
+            name, base['median'], result['median'], ratio, result['peak_kb'],
+            flag))
+    if baseline.get('engine') != results['engine']:
+        print('The baseline is of the {0} engine, not {1}'.format(
+            baseline.get('engine'), results['engine']))
+    return regressions
+
+
+@main
+def run(*argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the Scheme interpreter')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='tree',
+                        help='the evaluator to run the workloads with')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs of each workload to take the median time of')
+    parser.add_argument('--only', metavar='NAME', action='append', default=[],
+                        help='run only the workload NAME (may be repeated)')
+    parser.add_argument('--no-calls', action='store_true',
+                        help='do not run each workload again to count its calls')
+    parser.add_argument('--output', metavar='PATH', default=None,
+                        help='write the results to PATH as JSON')
+    parser.add_argument('--baseline', metavar='PATH', default=BASELINE,
+                        help='the results to compare with (default: bench/baseline.json)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='write the results to the baseline instead of comparing')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='the fraction slower than the baseline that is a regression')
+    args = parser.parse_args()
+
+    workloads = [(name, path) for name, path in WORKLOADS
+                 if not args.only or name in args.only]
+    unknown = set(args.only) - set(name for name, _ in WORKLOADS)
+    if unknown:
+        parser.error('unknown workloads: ' + ', '.join(sorted(unknown)))
+    results = {'engine': args.engine, 'python': sys.version.split()[0],
+               'repeat': args.repeat, 'workloads': {}}
+    for name, path in workloads:
+        result = measure(path, ENGINES[args.engine], args.repeat, not args.no_calls)
+        results['workloads'][name] = result
+        print('{0:<10} {1:>8.3f}s {2:>8} KB'.format(name, result['median'],
+                                                    result['peak_kb']),
+              file=sys.stderr)
+
+    failed = failures(results)
+    if failed:
+        print('Printed the wrong number of errors: ' + ', '.join(failed),
+              file=sys.stderr)
+    saved = args.baseline if args.save_baseline and not failed else None
+    for path in (args.output, saved):
+        if path is not None:
+            with open(path, 'w') as outfile:
+                json.dump(results, outfile, indent=2)
+    if args.save_baseline or not os.path.exists(args.baseline):
+        if failed:
+            sys.exit(1)
+        return
+    with open(args.baseline) as infile:
+        baseline = json.load(infile)
+    if compare(results, baseline, args.threshold):
+        sys.exit(1)
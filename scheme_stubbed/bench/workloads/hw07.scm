@@ -0,0 +1,14 @@
+; The hw07 exercises at scaled-up sizes. Run from the repository root.
+(load 'hw07/hw07)
+
+(define (times n thunk)
+  (if (= n 0)
+      'done
+      (begin (thunk) (times (- n 1) thunk))))
+
+(length (replicate (quote x) 20000))
+(accumulate + 0 20000 square)
+(accumulate-tail * 1 300 (lambda (x) x))
+(times 300 (lambda () (pow 3 500)))
+(times 50 (lambda () (unique (replicate 'a 80))))
+(times 2000 (lambda () (sign (- (cadr '(1 2 3)) (caddr '(1 2 3))))))
@@ -0,0 +1,18 @@
+; The hw09 exercises at scaled-up sizes. Run from the repository root.
+; reverse is not tail recursive, and the tree-walker cannot recurse much
+; more than 120 calls deep, so the lists stay that long and the work is
+; scaled up by repeating it.
+(load 'hw09/hw09)
+
+(define (range-list n result)
+  (if (= n 0)
+      result
+      (range-list (- n 1) (cons n result))))
+
+(define (times n thunk)
+  (if (= n 0)
+      'done
+      (begin (thunk) (times (- n 1) thunk))))
+
+(define numbers (range-list 120 nil))
+(times 200 (lambda () (reverse numbers)))
@@ -0,0 +1,22 @@
+; The lab10 exercises at scaled-up sizes. Run from the repository root.
+; As in hw09.scm, the lists are kept short enough for the tree-walker to
+; recurse through, and the work is scaled up by repeating it.
+(load 'lab10/lab10)
+
+(define (range-list n result)
+  (if (= n 0)
+      result
+      (range-list (- n 1) (cons (modulo n 7) result))))
+
+(define (times n thunk)
+  (if (= n 0)
+      'done
+      (begin (thunk) (times (- n 1) thunk))))
+
+(define numbers (range-list 120 nil))
+(define nested (list numbers (list numbers 3) 4 numbers))
+(times 150 (lambda () (filter-lst even? numbers)))
+(times 150 (lambda () (remove 3 numbers)))
+(times 15 (lambda () (no-repeats numbers)))
+(times 15 (lambda () (sub-all nested '(1 2 3) '(one two three))))
+(times 3000 (lambda () ((composed (make-adder 1) (make-adder 2)) 3)))
@@ -0,0 +1,20 @@
+; Code that is mostly macro calls, with quasiquote templates.
+(define-macro (my-unless c then otherwise)
+  `(if ,c ,otherwise ,then))
+
+(define-macro (my-and a b)
+  `(if ,a ,b #f))
+
+(define-macro (my-let1 name value body)
+  `((lambda (,name) ,body) ,value))
+
+(define-macro (swap-args f a b)
+  `(,f ,b ,a))
+
+(define (count n acc)
+  (my-unless (= n 0)
+             (my-let1 m (swap-args - 1 n)
+                      (count m (my-and (> n 0) `(,n ,@acc))))
+             (length acc)))
+
+(count 20000 nil)
@@ -0,0 +1,36 @@
+; Building a list of pseudo-random numbers and merge sorting it. Every
+; procedure is tail recursive but msort, which recurs to the depth of log n.
+(define (random-list n seed result)
+  (if (= n 0)
+      result
+      (random-list (- n 1)
+                   (modulo (+ (* seed 1103515245) 12345) 2147483648)
+                   (cons (modulo seed 100000) result))))
+
+(define (reverse-onto s result)
+  (if (null? s)
+      result
+      (reverse-onto (cdr s) (cons (car s) result))))
+
+(define (split s left right)
+  (if (null? s)
+      (list left right)
+      (split (cdr s) (cons (car s) right) left)))
+
+(define (merge a b result)
+  (cond ((null? a) (reverse-onto result b))
+        ((null? b) (reverse-onto result a))
+        ((< (car a) (car b)) (merge (cdr a) b (cons (car a) result)))
+        (else (merge a (cdr b) (cons (car b) result)))))
+
+(define (msort s)
+  (if (or (null? s) (null? (cdr s)))
+      s
+      (let ((halves (split s nil nil)))
+        (merge (msort (car halves)) (msort (car (cdr halves))) nil))))
+
+(define (sorted? s)
+  (or (null? s) (null? (cdr s))
+      (and (not (> (car s) (car (cdr s)))) (sorted? (cdr s)))))
+
+(sorted? (msort (random-list 2000 42 nil)))
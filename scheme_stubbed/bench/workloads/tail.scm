@@ -0,0 +1,13 @@
+; Deep tail recursion, which must run in constant stack space.
+(define (count-down n)
+  (if (= n 0)
+      'done
+      (count-down (- n 1))))
+
+(define (sum-to n total)
+  (if (= n 0)
+      total
+      (sum-to (- n 1) (+ total n))))
+
+(count-down 100000)
+(sum-to 100000 0)
@@ -1,8 +1,13 @@
 """A Scheme interpreter and its read-eval-print loop."""
 from __future__ import print_function  # Python 2 compatibility
 
-import sys
+import hashlib
 import os
+import pickle
+import sys
+import time
+from array import array
+from collections import OrderedDict
 
 from scheme_builtins import *
 from scheme_reader import *
@@ -26,7 +31,12 @@ def scheme_eval(expr, env, show_info=True): # Optional third argument is ignored
     """
     if not isinstance(expr, Pair):
         return env.lookup(expr)
-    return scheme_apply(scheme_eval(expr.first, env), expr.rest, env)
+    procedure = scheme_eval(expr.first, env)
+    if type(procedure) is BuiltinProcedure:
+        result = eval_builtin_call(procedure, expr.rest, env)
+        if result is not NotImplemented:
+            return result
+    return scheme_apply(procedure, expr.rest, env)
 
 
 def scheme_apply(procedure, args, env):
@@ -34,23 +44,70 @@ def scheme_apply(procedure, args, env):
     environment ENV."""
     if not isinstance(procedure, SpecialForm):
         args = args.map(lambda expr:scheme_eval(expr, env))
-    stack = [[procedure, args, env]]
-    result = None
-
-    while len(stack) != 0:
-        procedure, args, env = stack[-1]
-        stack = stack[:-1]
-        try:
-            result = procedure.apply(args, env, stack)
-        except AttributeError as err:
-            raise SchemeError(err)
-    return result
-
-def insert_pair(body, env, stack):
-    procedure, args = scheme_eval(body.first, env), body.rest
+    stack = CallStack()
+    stack.push(procedure, args, env)
+    return stack.run()
+
+class CallStack(list):
+    """The calls that a scheme_apply trampoline has yet to make, each a
+    (procedure, args, env) tuple. A procedure or special form that ends in a
+    call pushes it here rather than making it, so calls in tail position do
+    not grow the Python stack.
+
+    >>> env = create_global_frame()
+    >>> for line in ['(define (count n) (if (= n 0) 0 (+ 1 (count (- n 1)))))',
+    ...              "(define (loop n) (cond ((= n 0) 'done) ((< n 0) 'negative)"
+    ...              "  (else (let ((m (- n 1))) (and #t (or #f (begin (loop m))))))))"]:
+    ...     _ = scheme_eval(read_line(line), env)
+    >>> scheme_apply(env.lookup('count'), Pair(100, nil), env)
+    100
+    >>> scheme_apply(env.lookup('loop'), Pair(20000, nil), env)
+    'done'
+
+    A call that is not in tail position still takes Python stack, so a deep
+    enough recursion of them is an error, after which calls are made as
+    before.
+
+    >>> try:
+    ...     scheme_apply(env.lookup('count'), Pair(5000, nil), env)
+    ... except RecursionError:
+    ...     print('too deep')
+    too deep
+    >>> scheme_apply(env.lookup('count'), Pair(100, nil), env)
+    100
+    """
+    __slots__ = ()
+
+    def push(self, procedure, args, env):
+        self.append((procedure, args, env))
+
+    def run(self):
+        """Make the calls on SELF until it is empty, and return the value of
+        the last one made."""
+        if PROFILE is not None:
+            return PROFILE.trampoline(self)
+        result = None
+        while self:
+            procedure, args, env = self.pop()
+            try:
+                result = procedure.apply(args, env, self)
+            except AttributeError as err:
+                raise SchemeError(err)
+        return result
+
+def eval_tail(expr, env, stack):
+    """Evaluate EXPR, which is in tail position, in ENV. A call is pushed onto
+    STACK to be made by the trampoline, and None returned."""
+    if not isinstance(expr, Pair) or stack is None:
+        return scheme_eval(expr, env)
+    procedure, args = scheme_eval(expr.first, env), expr.rest
+    if type(procedure) is BuiltinProcedure:
+        result = eval_builtin_call(procedure, args, env)
+        if result is not NotImplemented:
+            return result
     if not isinstance(procedure, SpecialForm):
         args = args.map(lambda expr:scheme_eval(expr, env))
-    stack.append([procedure, args, env])
+    stack.push(procedure, args, env)
 
 
 
@@ -60,13 +117,17 @@ def insert_pair(body, env, stack):
 
 class Frame(object):
     """An environment frame binds Scheme symbols to Scheme values."""
+
+    __slots__ = ('parent', 'bindings')
+    layout = None  # Frames are dict-based; see ArrayFrame
+
     def __init__(self, parent):
         """An empty frame with parent frame PARENT (which may be None)."""
         self.parent = parent
         self.bindings = dict()
 
     def __repr__(self):
-        if self.parent is None:
+        if self.is_global:
             return '<Global Frame>'
         s = sorted(['{0}: {1}'.format(k, v) for k, v in self.bindings.items()])
         return '<{{{0}}} -> {1}>'.format(', '.join(s), repr(self.parent))
@@ -78,30 +139,102 @@ class Frame(object):
         self.bindings[symbol] = value
         return symbol
 
+    @property
+    def is_global(self):
+        """Whether SELF is a global frame, with no parent but the base frame."""
+        return self.parent is None or type(self.parent) is BaseFrame
+
     # BEGIN PROBLEM 2/3
     "*** YOUR CODE HERE ***"
     def lookup(self, name):
-        try:
-            if name in SPECIAL_FORMS:
-                return SPECIAL_FORMS[name]
-        except TypeError:
-            pass
-        if not isinstance(name, str):
-            return name
-        if name in self.bindings:
-            return self.bindings[name]
-        if self.parent is None:
-            raise SchemeError('name "{}" was not defined'.format(name))
-        else:
-            return self.parent.lookup(name)
+        if type(name) is not Symbol:
+            if not isinstance(name, str):
+                return name
+            name = intern(name)  # A name in an expression made in Python
+        if name.special:
+            return SPECIAL_FORMS[name]
+        frame = self
+        while frame is not None:
+            layout, bindings = frame.layout, frame.bindings
+            if layout is not None and name in layout:
+                value = frame.values[layout[name]]
+                if value is not UNASSIGNED:
+                    return value
+            elif bindings is not None and name in bindings:
+                return bindings[name]
+            frame = frame.parent
+        raise SchemeError('name "{}" was not defined'.format(name))
     # END PROBLEM 2/3
 
+class BaseFrame(Frame):
+    """The frame of the built-in names, which is the parent of every global
+    frame. It is made once, and cannot be changed after that, so that global
+    frames can share it: a define in a global frame binds the name in that
+    frame, and hides any built-in binding of it from that frame alone."""
+    __slots__ = ()
+
+    def __init__(self, bindings):
+        self.parent = None
+        self.bindings = bindings
+
+    def __repr__(self):
+        return '<Base Frame>'
+
+    def define(self, symbol, value):
+        raise SchemeError('cannot define {0} in the base frame'.format(symbol))
+
+UNASSIGNED = object()  # The value of a slot whose name is not yet defined
+
+class ArrayFrame(Frame):
+    """A frame for a procedure call or let in analyze mode, which keeps the
+    values of the names in LAYOUT in a list so that analyzed code can reach
+    them by index. Names defined that are not in the layout (by eval or a
+    macro expansion, for example) are kept in a dict in BINDINGS."""
+    __slots__ = ('layout', 'values')
+
+    def __init__(self, parent, layout, values):
+        self.parent = parent
+        self.layout = layout
+        self.values = values
+        self.bindings = None
+
+    def __repr__(self):
+        s = ['{0}: {1}'.format(k, self.values[i]) for k, i in self.layout.items()
+             if self.values[i] is not UNASSIGNED]
+        if self.bindings is not None:
+            s += ['{0}: {1}'.format(k, v) for k, v in self.bindings.items()]
+        return '<{{{0}}} -> {1}>'.format(', '.join(sorted(s)), repr(self.parent))
+
+    def define(self, symbol, value):
+        if not isinstance(symbol, str):
+            raise SchemeError('illegal name.')
+        if symbol in self.layout:
+            self.values[self.layout[symbol]] = value
+        else:
+            if self.bindings is None:
+                self.bindings = dict()
+            self.bindings[symbol] = value
+        return symbol
+
 ##############
 # Procedures #
 ##############
 
 class Procedure(object):
-    """The supertype of all Scheme procedures."""
+    """The supertype of all Scheme procedures. Procedures, like pairs and
+    frames, have __slots__ rather than a __dict__, to keep them small.
+
+    >>> env = create_global_frame()
+    >>> _ = analyze_eval(read_line('(define-macro (m x) x)'), env)
+    >>> values = [analyze_eval(read_line(line), env) for line in [
+    ...     '(lambda (x) x)', '(mu (x) x)', 'car', '(cons 1 nil)',
+    ...     '(memoize car)']]
+    >>> values += [env.lookup('m'), SPECIAL_FORMS['if'], env, Frame(env),
+    ...            ArrayFrame(env, {}, [])]
+    >>> [value for value in values if hasattr(value, '__dict__')]
+    []
+    """
+    __slots__ = ()
 
 def scheme_procedurep(x):
     return isinstance(x, Procedure)
@@ -109,10 +242,15 @@ def scheme_procedurep(x):
 class BuiltinProcedure(Procedure):
     """A Scheme procedure defined as a Python function."""
 
+    # UNARY and BINARY are the fast paths of FN for one and two arguments, if
+    # it has them; see FAST_PATHS.
+    __slots__ = ('name', 'fn', 'use_env', 'unary', 'binary')
+
     def __init__(self, fn, use_env=False, name='builtin'):
         self.name = name
         self.fn = fn
         self.use_env = use_env
+        self.unary, self.binary = FAST_PATHS.get(fn, (None, None))
 
     def __str__(self):
         return '#[{0}]'.format(self.name)
@@ -121,7 +259,7 @@ class BuiltinProcedure(Procedure):
         """Apply SELF to ARGS in ENV, where ARGS is a Scheme list.
 
         >>> env = create_global_frame()
-        >>> plus = env.bindings['+']
+        >>> plus = env.lookup('+')
         >>> twos = Pair(2, Pair(2, nil))
         >>> plus.apply(twos, env)
         4
@@ -132,18 +270,99 @@ class BuiltinProcedure(Procedure):
         while args != nil:
             lst.append(args.first)
             args = args.rest
+        return self.call(lst, env)
+        # END PROBLEM 2
+
+    def call(self, lst, env):
+        """Apply SELF to the Python list LST of argument values in ENV."""
         try:
             if self.use_env:
                 lst.append(env)
             return self.fn(*lst)
         except TypeError:
             raise SchemeError('type error')
-        # END PROBLEM 2
 
 
+def eval_builtin_call(procedure, operands, env):
+    """Evaluate a call to the BuiltinProcedure PROCEDURE with the Scheme list
+    OPERANDS in ENV by a fast path of PROCEDURE. Return NotImplemented, having
+    evaluated nothing, if it has none for that many operands.
+
+    In each engine, a call that a fast path cannot make fails with the same
+    error as it does through a builtin with no fast paths.
+
+    >>> def show(evaluate, line, env):
+    ...     try:
+    ...         return repl_str(evaluate(read_line(line), env))
+    ...     except SchemeError as err:
+    ...         return 'Error: ' + str(err)
+    >>> for line in ['(car 5)', '(car (list 1) 2)', '(cons 1)', '(not)',
+    ...              '(- (quote a))', '(+ 1 (quote a))', '(= 1 2 3)']:
+    ...     shown = set()
+    ...     for evaluate in (scheme_eval, analyze_eval, vm_eval):
+    ...         env = create_global_frame()
+    ...         shown.add(show(evaluate, line, env))
+    ...         name = line[1:].split()[0].rstrip(')')
+    ...         fn = env.lookup(name)
+    ...         slow = BuiltinProcedure(fn.fn, fn.use_env, fn.name)
+    ...         slow.unary = slow.binary = None
+    ...         _ = env.define(name, slow)
+    ...         shown.add(show(evaluate, line, env))
+    ...     print(line, *shown)
+    (car 5) Error: argument 0 of car has wrong type (int)
+    (car (list 1) 2) Error: type error
+    (cons 1) Error: type error
+    (not) Error: type error
+    (- (quote a)) Error: operand 0 (a) is not a number
+    (+ 1 (quote a)) Error: operand 1 (a) is not a number
+    (= 1 2 3) Error: type error
+
+    A name of a builtin that is bound to something else calls that instead.
+
+    >>> for evaluate in (scheme_eval, analyze_eval, vm_eval):
+    ...     env = create_global_frame()
+    ...     for line in ["(define (car x) 'mine)", '(define + -)',
+    ...                  '(define (f cons) (cons 1 2))']:
+    ...         _ = evaluate(read_line(line), env)
+    ...     print(*(show(evaluate, line, env) for line in
+    ...             ['(car (list 1))', '(+ 5 3)', '(f list)']))
+    mine 2 (1 2)
+    mine 2 (1 2)
+    mine 2 (1 2)
+    """
+    if not isinstance(operands, Pair):
+        return NotImplemented
+    rest = operands.rest
+    if rest is nil and procedure.unary is not None:
+        value = scheme_eval(operands.first, env)
+        result = procedure.unary(value)
+        if result is NotImplemented:
+            args = Pair(value, nil)
+    elif (isinstance(rest, Pair) and rest.rest is nil and
+          procedure.binary is not None):
+        first = scheme_eval(operands.first, env)
+        second = scheme_eval(rest.first, env)
+        result = procedure.binary(first, second)
+        if result is NotImplemented:
+            args = Pair(first, Pair(second, nil))
+    else:
+        return NotImplemented
+    if result is NotImplemented:  # Report the error as an ordinary call would
+        stack = CallStack()
+        stack.push(procedure, args, env)
+        return stack.run()
+    return result
+
 class LambdaProcedure(Procedure):
     """A procedure defined by a lambda expression or a define form."""
 
+    # PARAMS, LAYOUT and one of EXECUTE or CODE are set for procedures
+    # created in analyze mode or by the VM: the tuple of formal parameter
+    # names, the layout of the frames of calls, and the analyzed body or its
+    # bytecode. NAME is the name the procedure was first defined as, if any.
+    __slots__ = ('formals', 'body', 'env', 'params', 'layout', 'execute', 'code',
+                 'name')
+
     def __init__(self, formals, body, env):
         """A procedure with formal parameter list FORMALS (a Scheme list),
         whose body is the Scheme list BODY, and whose parent environment
@@ -151,6 +370,8 @@ class LambdaProcedure(Procedure):
         self.formals = formals
         self.body = body
         self.env = env
+        self.params = self.layout = self.execute = self.code = None
+        self.name = None
 
     def __str__(self):
         return str(Pair('lambda', Pair(self.formals, self.body)))
@@ -160,28 +381,40 @@ class LambdaProcedure(Procedure):
             repr(self.formals), repr(self.body), repr(self.env))
     
     def apply(self, args, env, stack = None, use_current_env = False):
-        if len(args) != len(self.formals):
-            raise SchemeError('requires {0} argument(s) but gets {1}'.format(len(self.formals), len(self.args)))
+        if self.execute is not None or self.code is not None:
+            values = []
+            while args is not nil:
+                values.append(args.first)
+                args = args.rest
+            if self.code is not None:
+                return vm_apply(self, values, env)
+            return execute_call(self, values, env)
         if use_current_env:
-            env = Frame(env)
+            frame = Frame(env)
         else:
-            env = Frame(self.env)
-        
+            frame = Frame(self.env)
+
         para, arg = self.formals, args
-        while para != nil:
-            env.define(para.first, arg.first)
+        while para is not nil and arg is not nil:
+            frame.define(para.first, arg.first)
             para, arg = para.rest, arg.rest
-        
+        if para is not nil or arg is not nil:
+            raise SchemeError('requires {0} argument(s) but gets {1}'.format(len(self.formals), len(args)))
+        env = frame
+
         body = self.body
         while body.rest != nil:
             scheme_eval(body.first, env)
             body = body.rest
         
-        # tail recursion
-        if True:
-            if isinstance(body.first, Pair):
-                return insert_pair(body.first, env, stack)
-        return scheme_eval(body.first, env)
+        return eval_tail(body.first, env, stack)
+
+def name_procedure(value, name):
+    """Give VALUE the name NAME if it is a procedure without one, as when it
+    is the value of a define form. Return VALUE."""
+    if isinstance(value, LambdaProcedure) and value.name is None:
+        value.name = name
+    return value
 
 def add_builtins(frame, funcs_and_names):
     """Enter bindings in FUNCS_AND_NAMES into FRAME, an environment frame,
@@ -190,6 +423,104 @@ def add_builtins(frame, funcs_and_names):
     for name, fn, proc_name in funcs_and_names:
         frame.define(name, BuiltinProcedure(fn, name=proc_name))
 
+##############
+# Fast Paths #
+##############
+
+# Builtins with a fixed number of arguments are called by each evaluator
+# through their fast paths, which take their arguments directly rather than in
+# a list. A fast path returns NotImplemented for arguments that it does not
+# handle, such as a number and a symbol, and the builtin is then called as
+# usual, to compute its value or report the error. The evaluators look up the
+# operator of each call as usual, so a builtin that is rebound is not called.
+
+NUMBER_TYPES = (int, float)  # Not bool, which is a subclass of int
+
+def float_result(x):
+    """Return the float X as scheme_builtins' arithmetic would, or
+    NotImplemented if it is not finite."""
+    if x.is_integer():
+        return int(x)
+    if x - x == 0:
+        return x
+    return NotImplemented
+
+def fast_add(x, y):
+    if type(x) is int and type(y) is int:
+        return x + y
+    if type(x) in NUMBER_TYPES and type(y) in NUMBER_TYPES:
+        return float_result(x + y)
+    return NotImplemented
+
+def fast_sub(x, y):
+    if type(x) is int and type(y) is int:
+        return x - y
+    if type(x) in NUMBER_TYPES and type(y) in NUMBER_TYPES:
+        return float_result(x - y)
+    return NotImplemented
+
+def fast_mul(x, y):
+    if type(x) is int and type(y) is int:
+        return x * y
+    if type(x) in NUMBER_TYPES and type(y) in NUMBER_TYPES:
+        return float_result(x * y)
+    return NotImplemented
+
+def fast_neg(x):
+    if type(x) is int:
+        return -x
+    return NotImplemented
+
+def fast_modulo(x, y):
+    if type(x) is int and type(y) is int and y:
+        return x % y
+    return NotImplemented
+
+def fast_comparison(op):
+    def compare(x, y):
+        if type(x) in NUMBER_TYPES and type(y) in NUMBER_TYPES:
+            return op(x, y)
+        return NotImplemented
+    return compare
+
+def fast_zerop(x):
+    if type(x) in NUMBER_TYPES:
+        return x == 0
+    return NotImplemented
+
+def fast_car(x):
+    if type(x) is Pair:
+        return x.first
+    return NotImplemented
+
+def fast_cdr(x):
+    if type(x) is Pair:
+        return x.rest
+    return NotImplemented
+
+# The unary and binary fast paths of builtins, by their Python functions.
+# Builtins that take exactly one or two arguments and never fail are their own
+# fast paths.
+FAST_PATHS = {
+    scheme_add: (None, fast_add),
+    scheme_sub: (fast_neg, fast_sub),
+    scheme_mul: (None, fast_mul),
+    scheme_modulo: (None, fast_modulo),
+    scheme_eq: (None, fast_comparison(lambda x, y: x == y)),
+    scheme_lt: (None, fast_comparison(lambda x, y: x < y)),
+    scheme_gt: (None, fast_comparison(lambda x, y: x > y)),
+    scheme_le: (None, fast_comparison(lambda x, y: x <= y)),
+    scheme_ge: (None, fast_comparison(lambda x, y: x >= y)),
+    scheme_zerop: (fast_zerop, None),
+    scheme_car: (fast_car, None),
+    scheme_cdr: (fast_cdr, None),
+    scheme_cons: (None, scheme_cons),
+    scheme_nullp: (scheme_nullp, None),
+    scheme_pairp: (scheme_pairp, None),
+    scheme_not: (scheme_not, None),
+    scheme_eqp: (None, scheme_eqp),
+}
+
 #################
 # Special Forms #
 #################
@@ -200,6 +531,7 @@ logic for each special form separately somehow, which you can do here.
 """
 
 class SpecialForm(Procedure):
+    __slots__ = ('name', 'fn')
 
     def __init__(self, fn, name='special form'):
         self.name = name
@@ -212,14 +544,71 @@ class SpecialForm(Procedure):
         return self.fn(args, env, stack)
 
 class MacroProcedure(SpecialForm):
+    """A macro defined by define-macro. Each call site is expanded the first
+    time it is reached; the expansion is kept, keyed by the identity of the
+    call site's operands, and evaluated again each time the site is reached
+    after that. The VM keeps the bytecode it compiles the expansion to along
+    with it, and analyze mode the function it analyzes it into.
+
+    A kept expansion is evaluated again, operands and all, each time its call
+    site is reached, and redefining the macro forgets it.
+
+    >>> for evaluate in (scheme_eval, analyze_eval, vm_eval):
+    ...     env = create_global_frame()
+    ...     for line in ['(define-macro (twice e) `(begin ,e ,e))',
+    ...                  '(define (f x) (twice (display x)))',
+    ...                  '(f 1)', '(f 2)']:
+    ...         _ = evaluate(read_line(line), env)
+    ...     old = env.lookup('twice')
+    ...     print(' kept', len(old.expansions))
+    ...     _ = evaluate(read_line("(define-macro (twice e) `',e)"), env)
+    ...     print('kept', len(old.expansions))
+    ...     print(evaluate(read_line('(f 3)'), env))
+    1122 kept 1
+    kept 0
+    (display x)
+    1122 kept 1
+    kept 0
+    (display x)
+    1122 kept 1
+    kept 0
+    (display x)
+    """
+
+    __slots__ = ('formals', 'body', 'env', 'expansions')
+    cache_size = 1000  # Call sites whose expansions are kept, per macro
 
     def __init__(self, formals, body, env, name = 'macro'):
         self.formals = formals
         self.body = body
         self.env = env
         self.name = name
+        self.expansions = dict()
+
+    def invalidate(self):
+        """Forget all expansions, as when the macro is redefined."""
+        self.expansions.clear()
 
     def apply(self, args, env, stack = None):
+        return scheme_begin(self.expansion(args, env)[1], env, stack)
+
+    def expansion(self, args, env):
+        """Return the kept expansion of the call site with operands ARGS in
+        ENV, a list of ARGS, the expressions it expands to, their bytecode or
+        None, and their analyzed function or None."""
+        # The operands are kept with their expansion so that their id is not
+        # reused while it is a key.
+        entry = self.expansions.get(id(args))
+        if entry is None or entry[0] is not args:
+            entry = [args, self.expand(args, env), None, None]
+            if len(self.expansions) >= self.cache_size:
+                del self.expansions[next(iter(self.expansions))]
+            self.expansions[id(args)] = entry
+        return entry
+
+    def expand(self, args, env):
+        """Return the Scheme list of expressions that a call with operands
+        ARGS in ENV expands to."""
         if len(args) != len(self.formals):
             raise SchemeError('arguments number error')
         
@@ -234,23 +623,25 @@ class MacroProcedure(SpecialForm):
                 return nil
             elif not isinstance(pair, Pair):
                 if pair in bindings:
-                    return Pair('quote', Pair(bindings[pair], nil))
+                    return Pair(intern('quote'), Pair(bindings[pair], nil))
                 else:
                     return pair
             return Pair(replace(pair.first), replace(pair.rest))
         
-        body = replace(self.body).map(lambda expr:scheme_eval(expr, env))
-        return scheme_begin(body, env, stack)
+        return replace(self.body).map(lambda expr:scheme_eval(expr, env))
 
 def special_form(name):
     def add(fn):
-        SPECIAL_FORMS[name] = SpecialForm(fn, name)
+        symbol = intern(name)
+        symbol.special = True
+        SPECIAL_FORMS[symbol] = SpecialForm(fn, symbol)
         return fn
     return add
 
 def check_argument(args, req):
-    if not req(len(args)):
-        raise SchemeError('get {} arguments'.format(len(args)))
+    length = len(args)
+    if not req(length):
+        raise SchemeError('get {} arguments'.format(length))
 
 @special_form("define")
 def scheme_define(args, env, stack):
@@ -259,9 +650,26 @@ def scheme_define(args, env, stack):
     symbol = args.first
     if isinstance(symbol, Pair):
         fn = scheme_lambda(Pair(args.first.rest, args.rest), env, stack)
-        return env.define(args.first.first, fn)
+        return env.define(args.first.first, name_procedure(fn, symbol.first))
     value = scheme_eval(args.rest.first, env)
-    return env.define(symbol, value)
+    return env.define(symbol, name_procedure(value, symbol))
+
+@special_form("define-memo")
+def scheme_define_memo(args, env, stack):
+    return scheme_begin(expand_define_memo(args).rest, env, stack)
+
+def expand_define_memo(args):
+    """Return the expression that (define-memo (NAME . FORMALS) BODY...), with
+    operands ARGS, stands for: a define of NAME, followed by a define of NAME
+    as the memoized procedure."""
+    check_argument(args, lambda x:x>=2)
+    if not isinstance(args.first, Pair):
+        raise SchemeError('define-memo needs a name and formals: {0}'.format(
+            repl_str(args.first)))
+    name = args.first.first
+    define = intern('define')
+    return scheme_list(intern('begin'), Pair(define, args),
+                       scheme_list(define, name, scheme_list(MEMOIZE, name)))
 
 @special_form("define-macro")
 def scheme_define_macro(args, env, stack):
@@ -269,6 +677,12 @@ def scheme_define_macro(args, env, stack):
     
     symbol = args.first
     fn = MacroProcedure(args.first.rest, args.rest, env, args.first.first)
+    try:
+        old = env.lookup(symbol.first)
+    except SchemeError:
+        old = None
+    if isinstance(old, MacroProcedure):
+        old.invalidate()
     return env.define(args.first.first, fn)
 
 @special_form("quote")
@@ -281,22 +695,128 @@ def scheme_quote(args, env, stack):
 @special_form("quasiquote")
 def scheme_quasiquote(args, env, stack):
     check_argument(args, lambda x:x==1)
-    
-    symbol = args.first
-    if isinstance(symbol, Pair):
-        if symbol.first == 'unquote':
-            return scheme_unquote(symbol.rest, env, stack, True)
-        return symbol.map(lambda expr:scheme_quasiquote(Pair(expr, nil), env, stack))
-    return symbol
+
+    build, exprs = cached_quasiquote(args)
+    return build(iter([scheme_eval(expr, env) for expr in exprs]))
 
 @special_form("unquote")
-def scheme_unquote(args, env, stack, inside_quasiquote = False):
+def scheme_unquote(args, env, stack):
     check_argument(args, lambda x:x==1)
-    
-    if not inside_quasiquote:
-        raise SchemeError('unquote outside of a quasiquote')
-    symbol = args.first
-    return scheme_eval(symbol, env)
+
+    raise SchemeError('unquote outside of a quasiquote')
+
+@special_form("unquote-splicing")
+def scheme_unquote_splicing(args, env, stack):
+    check_argument(args, lambda x:x==1)
+
+    raise SchemeError('unquote-splicing outside of a quasiquote')
+
+# A quasiquote template is compiled once into a list of the expressions that
+# it unquotes, in order, and a function that builds its value from an
+# iterator over their values. Parts of the template without unquotes are not
+# rebuilt: the value shares them with the template, as it would if they were
+# quoted. The tree-walker keeps the compiled templates, keyed by the identity
+# of the operands of the quasiquote, as MacroProcedure keeps expansions.
+
+QUASIQUOTE_CACHE_SIZE = 1000  # Templates whose compiled forms are kept
+QUASIQUOTE_CACHE = dict()
+
+def cached_quasiquote(args):
+    """Return compile_quasiquote(ARGS), compiling ARGS only the first time."""
+    template, compiled = QUASIQUOTE_CACHE.get(id(args), (None, None))
+    if template is not args:
+        compiled = compile_quasiquote(args)
+        if len(QUASIQUOTE_CACHE) >= QUASIQUOTE_CACHE_SIZE:
+            del QUASIQUOTE_CACHE[next(iter(QUASIQUOTE_CACHE))]
+        QUASIQUOTE_CACHE[id(args)] = (args, compiled)
+    return compiled
+
+def compile_quasiquote(args):
+    """Return a function that builds the value of (quasiquote TEMPLATE), with
+    operands ARGS, from an iterator over the values of the expressions it
+    unquotes, and a Python list of those expressions.
+
+    >>> args = read_line('(((a ,b) (c d) ,@e))')
+    >>> build, exprs = compile_quasiquote(args)
+    >>> exprs
+    ['b', 'e']
+    >>> value = build(iter([1, read_line('(2 3)')]))
+    >>> print(value)
+    ((a 1) (c d) 2 3)
+    >>> value.rest.first is args.first.rest.first
+    True
+    """
+    check_argument(args, lambda x:x==1)
+    exprs = []
+    template = args.first
+    build = quasiquote_builder(template, 1, exprs)
+    if build is None:
+        return (lambda values: template), exprs
+    return build, exprs
+
+def quasiquote_form(template, name):
+    """Whether TEMPLATE is a form (NAME EXPR)."""
+    return (isinstance(template, Pair) and template.first == name and
+            isinstance(template.rest, Pair) and template.rest.rest is nil)
+
+def quasiquote_builder(template, depth, exprs):
+    """Return a function that builds the value of TEMPLATE, nested in DEPTH
+    quasiquotes, appending to EXPRS the expressions it unquotes, or None if
+    it has none and is its own value."""
+    if not isinstance(template, Pair):
+        return None
+    if quasiquote_form(template, 'unquote'):
+        if depth == 1:
+            exprs.append(template.rest.first)
+            return next
+        depth -= 1
+    elif quasiquote_form(template, 'unquote-splicing'):
+        if depth == 1:
+            raise SchemeError('unquote-splicing not in a list: ' + repl_str(template))
+        depth -= 1
+    elif quasiquote_form(template, 'quasiquote'):
+        depth += 1
+    elif template.first in ('unquote', 'unquote-splicing') and depth == 1:
+        raise SchemeError('{0} takes one operand'.format(template.first))
+
+    parts, spine = [], template  # (builder, pair, splice) for each element
+    while isinstance(spine, Pair):
+        if spine is not template and (quasiquote_form(spine, 'unquote') or
+                                      quasiquote_form(spine, 'unquote-splicing') or
+                                      quasiquote_form(spine, 'quasiquote')):
+            break  # A template (a . ,b) is read as (a unquote b)
+        element = spine.first
+        if depth == 1 and quasiquote_form(element, 'unquote-splicing'):
+            exprs.append(element.rest.first)
+            parts.append((next, spine, True))
+        else:
+            parts.append((quasiquote_builder(element, depth, exprs), spine, False))
+        spine = spine.rest
+    build_tail = quasiquote_builder(spine, depth, exprs)
+    if build_tail is None:
+        while parts and parts[-1][0] is None:  # Share the constant end
+            spine = parts.pop()[1]
+        if not parts:
+            return None
+        tail = spine
+        build_tail = lambda values: tail
+
+    def build(values):
+        items = [pair.first if builder is None else builder(values)
+                 for builder, pair, _ in parts]
+        result = build_tail(values)
+        for (_, _, splice), item in zip(reversed(parts), reversed(items)):
+            if not splice:
+                result = Pair(item, result)
+            elif result is nil and (item is nil or isinstance(item, Pair)):
+                result = item  # Shared, as append shares its last argument
+            elif not scheme_listp(item):
+                raise SchemeError('unquote-splicing used on non-list: ' + repl_str(item))
+            else:
+                for value in reversed(item.to_list()):
+                    result = Pair(value, result)
+        return result
+    return build
 
 @special_form("begin")
 def scheme_begin(args, env, stack):
@@ -304,9 +824,7 @@ def scheme_begin(args, env, stack):
         scheme_eval(args.first, env)
         args = args.rest
     
-    if isinstance(args.first, Pair):
-        return insert_pair(args.first, env, stack)
-    return scheme_eval(args.first, env)
+    return eval_tail(args.first, env, stack)
 
 @special_form("lambda")
 def scheme_lambda(args, env, stack):
@@ -328,34 +846,35 @@ def scheme_if(args, env, stack):
     
     cond, suite, alter = args.first, args.rest.first, args.rest.rest.first
     if is_true_primitive(scheme_eval(cond, env)):
-        if isinstance(suite, Pair):
-            return insert_pair(suite, env, stack)
-        else:
-            return scheme_eval(suite, env)
+        return eval_tail(suite, env, stack)
     else:
-        if isinstance(alter, Pair):
-            return insert_pair(alter, env, stack)
-        else:
-            return scheme_eval(alter, env)
+        return eval_tail(alter, env, stack)
 
 @special_form("cond")
 def scheme_cond(args, env, stack):
-    if len(args) == 0:
-        return None
-    
-    term = args.first
-    check_argument(term, lambda x:x>=1)
-    
-    if term.first == 'else':
-        return scheme_begin(Pair(True, term.rest), env, stack)
+    """Evaluate the first clause of the cond form with clauses ARGS whose test
+    is true, looping rather than recurring over the clauses.
+
+    >>> clauses = ' '.join('((= x {0}) {0})'.format(i) for i in range(5000))
+    >>> expr = read_line("((lambda (x) (cond {0} (else 'none))) 4999)".format(clauses))
+    >>> [evaluate(expr, create_global_frame())
+    ...  for evaluate in (scheme_eval, analyze_eval, vm_eval)]
+    [4999, 4999, 4999]
+    """
+    while args is not nil:
+        term = args.first
+        check_argument(term, lambda x:x>=1)
 
-    val = scheme_eval(term.first, env)
-    if is_true_primitive(val):
-        if len(term.rest) == 0:
-            return val
-        return scheme_begin(term.rest, env, stack)
-    else:
-        return scheme_cond(args.rest, env, stack)
+        if term.first == 'else':
+            return scheme_begin(Pair(True, term.rest), env, stack)
+
+        val = scheme_eval(term.first, env)
+        if is_true_primitive(val):
+            if term.rest is nil:
+                return val
+            return scheme_begin(term.rest, env, stack)
+        args = args.rest
+    return None
 
 @special_form("and")
 def scheme_and(args, env, stack):
@@ -366,10 +885,7 @@ def scheme_and(args, env, stack):
         if is_false_primitive(val):
             return val
         args = args.rest
-    if isinstance(args.first, Pair):
-        return insert_pair(args.first, env, stack)
-    else:
-        return scheme_eval(args.first, env)
+    return eval_tail(args.first, env, stack)
 
 @special_form("or")
 def scheme_or(args, env, stack):
@@ -380,10 +896,7 @@ def scheme_or(args, env, stack):
         if is_true_primitive(val):
             return val
         args = args.rest
-    if isinstance(args.first, Pair):
-        return insert_pair(args.first, env, stack)
-    else:
-        return scheme_eval(args.first, env)
+    return eval_tail(args.first, env, stack)
 
 @special_form("let")
 def scheme_let(args, env, stack):
@@ -400,6 +913,32 @@ def scheme_let(args, env, stack):
     
     return scheme_begin(body, my_frame, stack)
 
+@special_form("delay")
+def scheme_delay(args, env, stack):
+    check_argument(args, lambda x:x==1)
+
+    expr = args.first
+    return Promise(lambda: scheme_eval(expr, Frame(env)))
+
+@special_form("cons-stream")
+def scheme_cons_stream(args, env, stack):
+    check_argument(args, lambda x:x==2)
+
+    return Pair(scheme_eval(args.first, env), scheme_delay(args.rest, env, stack))
+
+def expand_delay(args):
+    """Return an expression equivalent to (delay EXPR), with operands ARGS,
+    that analyze and vm_compile can compile: a call that makes a Promise of
+    a procedure of no arguments whose body is EXPR."""
+    check_argument(args, lambda x:x==1)
+    return scheme_list(MAKE_PROMISE, scheme_list(intern('lambda'), nil, args.first))
+
+def expand_cons_stream(args):
+    """Return an expression equivalent to (cons-stream FIRST REST), with
+    operands ARGS, in terms of delay."""
+    check_argument(args, lambda x:x==2)
+    return scheme_list(CONS, args.first, scheme_list(intern('delay'), args.rest.first))
+
 
 # Utility methods for checking the structure of Scheme programs
 
@@ -462,12 +1001,16 @@ class MuProcedure(LambdaProcedure):
                     ||----w |
                     ||     ||
     """
+    __slots__ = ()
 
     def __init__(self, formals, body):
         """A procedure with formal parameter list FORMALS (a Scheme list) and
         Scheme list BODY as its definition."""
         self.formals = formals
         self.body = body
+        self.env = None
+        self.params = self.layout = self.execute = self.code = None
+        self.name = None
 
 
     def __str__(self):
@@ -488,14 +1031,1617 @@ class MuProcedure(LambdaProcedure):
 # Make classes/functions for creating tail recursive programs here?
 
 def complete_apply(procedure, args, env):
-    """Apply procedure to args in env; ensure the result is not a Thunk.
-    Right now it just calls scheme_apply, but you will need to change this
-    if you attempt the extra credit."""
-    val = scheme_apply(procedure, args.map(lambda expr: Pair('quote', Pair(expr, nil))), env)
-    # Add stuff here?
-    return val
+    """Apply procedure to args in env; ensure the result is not a Thunk."""
+    validate_type(args, scheme_listp, 1, 'apply')
+    return value_applier(procedure, env)(args.to_list())
+
+def value_applier(procedure, env):
+    """Return a function that applies PROCEDURE in ENV to a Python list of
+    argument values, which it may change. Values are passed as they are,
+    rather than quoted to be evaluated again, and tree-walked calls share one
+    trampoline, so applying a procedure to many lists is cheap.
+
+    >>> env = create_global_frame()
+    >>> square = value_applier(scheme_eval(read_line('(lambda (x) (* x x))'), env), env)
+    >>> [square([x]) for x in range(4)]
+    [0, 1, 4, 9]
+    """
+    if isinstance(procedure, BuiltinProcedure):
+        return lambda values: procedure.call(values, env)
+    elif isinstance(procedure, LambdaProcedure):
+        if procedure.code is not None:
+            return lambda values: vm_apply(procedure, values, env)
+        elif procedure.execute is not None:
+            return lambda values: execute_call(procedure, values, env)
+        stack = CallStack()
+        def apply(values):
+            stack.push(procedure, Pair.from_iterable(values), env)
+            return stack.run()
+        return apply
+    def apply(values):  # A special form needs its operands quoted
+        operands = Pair.from_iterable([Pair(intern('quote'), Pair(value, nil))
+                                       for value in values])
+        return scheme_apply(procedure, operands, env)
+    return apply
+
+
+
+############
+# Analysis #
+############
+
+# An alternative to scheme_eval in the style of SICP's analyze/execute split:
+# analyze compiles an expression once into a Python function of an
+# environment, so that the syntax of a lambda body is dispatched on only once
+# rather than every time the body runs.
+#
+# Analysis also resolves each symbol in a lambda or let body to the frame and
+# slot it is bound in. Procedure calls and lets in analyze mode create
+# ArrayFrames laid out by the Scope of their body, so a reference to a local
+# name is a list index rather than a chain of dict probes.
+
+class TailCall(object):
+    """A call in tail position, returned by an analyzed body instead of being
+    made so that execute_call can run it without growing the Python stack."""
+    __slots__ = ('procedure', 'values', 'env')
+
+    def __init__(self, procedure, values, env):
+        self.procedure = procedure
+        self.values = values
+        self.env = env
+
+class Scope(object):
+    """The names bound in the frames that a lambda or let body runs in: the
+    formals or let names NAMES, then the names defined in BODY. An opaque
+    scope (for a mu body) has no layout, since what its body refers to
+    depends on the caller.
+
+    >>> env = create_global_frame()
+    >>> for line in ['(define x 100)',
+    ...              '(define (f x) (define y (* x 2)) (+ x y))',
+    ...              '(define (g x) (let ((x (+ x 1))) (list x (f x))))',
+    ...              '(define (adder n) (lambda (m) (+ n m)))',
+    ...              '(define add2 (adder 2))', '(define add5 (adder 5))',
+    ...              '(define (h x) (define x (* x 10)) (add2 x))']:
+    ...     _ = analyze_eval(read_line(line), env)
+    >>> for line in ['(f 3)', '(g 1)', 'x', '(list (add2 1) (add5 1))', '(h 4)']:
+    ...     print(repl_str(analyze_eval(read_line(line), env)))
+    9
+    (2 6)
+    100
+    (3 6)
+    42
+    """
+
+    def __init__(self, names, body, parent, opaque=False):
+        self.parent = parent
+        self.opaque = opaque
+        self.layout = {}
+        if not opaque:
+            for name in list(names) + defined_names(body):
+                if name not in self.layout:
+                    self.layout[name] = len(self.layout)
+
+def defined_names(exprs):
+    """Return the names that may be defined in the frame that the Scheme list
+    EXPRS is evaluated in. Nested scopes and quotations are not searched, and
+    names defined some other way (such as by a macro) are not found; such
+    names are kept in the bindings of an ArrayFrame instead."""
+    names = []
+    def scan(expr):
+        if not isinstance(expr, Pair):
+            return
+        first, args = expr.first, expr.rest
+        if not (isinstance(first, Symbol) and first.special):
+            scan_all(expr)
+        elif (first in ('define', 'define-macro', 'define-memo') and
+              isinstance(args, Pair)):
+            target = args.first
+            if isinstance(target, Pair):
+                target = target.first
+            elif first == 'define':
+                scan_all(args.rest)
+            if isinstance(target, str):
+                names.append(target)
+        elif first in ('if', 'and', 'or', 'begin'):
+            scan_all(args)
+        elif first == 'cond':
+            while isinstance(args, Pair):
+                scan_all(args.first)
+                args = args.rest
+        elif first == 'let' and isinstance(args, Pair):
+            bindings = args.first
+            while isinstance(bindings, Pair):
+                if isinstance(bindings.first, Pair):
+                    scan_all(bindings.first.rest)
+                bindings = bindings.rest
+    def scan_all(exprs):
+        while isinstance(exprs, Pair):
+            scan(exprs.first)
+            exprs = exprs.rest
+    scan_all(exprs)
+    return names
+
+def analyze(expr, tail=False, scope=None):
+    """Return a function of an environment that evaluates EXPR in it. If TAIL,
+    a call in tail position is returned as a TailCall rather than made. SCOPE
+    is the Scope of the frame the function will be called with, or None for
+    an environment with no known layout.
+
+    >>> analyze(read_line('(+ 2 2)'))(create_global_frame())
+    4
+    """
+    if isinstance(expr, Pair):
+        first = expr.first
+        if isinstance(first, Symbol) and first.special:
+            analyzer = ANALYZERS.get(first)
+            args = (expr.rest, tail, scope)
+        else:
+            analyzer = analyze_call
+            args = (expr, tail, scope)
+        if analyzer is not None:
+            try:
+                return analyzer(*args)
+            except SchemeError:
+                pass  # Ill-formed; report the error when it is evaluated
+        return lambda env: scheme_eval(expr, env)
+    elif isinstance(expr, str):
+        if isinstance(expr, Symbol) and expr.special:
+            form = SPECIAL_FORMS[expr]
+            return lambda env: form
+        return analyze_symbol(expr, scope)
+    else:
+        return lambda env: expr
+
+def analyze_eval(expr, env):
+    """Evaluate EXPR in ENV by analyzing it and then executing it.
+
+    >>> try:
+    ...     analyze_eval(read_line('(5 3)'), create_global_frame())
+    ... except SchemeError as err:
+    ...     print('Error:', err)
+    Error: 'int' object has no attribute 'apply'
+    """
+    try:
+        return analyze(expr)(env)
+    except (AttributeError, TypeError) as err:
+        raise SchemeError(err)
+
+def analyze_symbol(name, scope):
+    """Analyze a reference to NAME into a slot lookup if some frame in SCOPE
+    binds it, or into a lookup by name past the frames that do not."""
+    depth = 0
+    while scope is not None and not scope.opaque:
+        if name in scope.layout:
+            return analyze_address(name, depth, scope.layout[name])
+        scope, depth = scope.parent, depth + 1
+    def execute(env):
+        for _ in range(depth):
+            if env.bindings is not None and name in env.bindings:
+                return env.bindings[name]
+            env = env.parent
+        if env.layout is None:
+            if name in env.bindings:
+                return env.bindings[name]
+            parent = env.parent
+            if parent is BASE_FRAME and name in parent.bindings:
+                return parent.bindings[name]
+        return env.lookup(name)
+    return execute
+
+def analyze_address(name, depth, index):
+    """Analyze a reference to NAME in slot INDEX of the frame DEPTH frames up.
+    A frame on the way may have had NAME defined in its bindings after it was
+    analyzed, and the slot may not have been defined yet; in either case the
+    name is looked up instead."""
+    if depth == 0:
+        def execute(env):
+            value = env.values[index]
+            if value is UNASSIGNED:
+                return env.parent.lookup(name)
+            return value
+        return execute
+    def execute(env):
+        for _ in range(depth):
+            if env.bindings is not None and name in env.bindings:
+                return env.bindings[name]
+            env = env.parent
+        value = env.values[index]
+        if value is UNASSIGNED:
+            return env.parent.lookup(name)
+        return value
+    return execute
+
+def analyze_sequence(exprs, tail, scope):
+    """Analyze the non-empty Scheme list EXPRS, to be evaluated in order for
+    the value of the last."""
+    check_argument(exprs, lambda x:x>=1)
+    executors = []
+    while exprs.rest is not nil:
+        executors.append(analyze(exprs.first, False, scope))
+        exprs = exprs.rest
+    last = analyze(exprs.first, tail, scope)
+    if not executors:
+        return last
+    executors = tuple(executors)
+    def execute(env):
+        for executor in executors:
+            executor(env)
+        return last(env)
+    return execute
+
+def analyze_call(expr, tail, scope):
+    """Analyze the call EXPR. The expansion of a macro call in tail position
+    is in tail position too.
+
+    >>> env = create_global_frame()
+    >>> for line in ["(define-macro (when c body) `(if ,c ,body 'done))",
+    ...              '(define (loop n) (when (> n 0) (loop (- n 1))))']:
+    ...     _ = analyze_eval(read_line(line), env)
+    >>> analyze_eval(read_line('(loop 5000)'), env)
+    'done'
+    >>> analyze_eval(read_line('(list (when #t 1) (when #f 2))'), env)
+    Pair(1, Pair('done', nil))
+    """
+    operator, operands = analyze(expr.first, False, scope), expr.rest
+    executors = tuple(analyze(operand, False, scope)
+                      for operand in operands_list(operands))
+    def call(procedure, env):
+        if type(procedure) is MacroProcedure and PROFILE is None:
+            return expand_call(procedure, env)
+        if isinstance(procedure, SpecialForm):
+            return scheme_apply(procedure, operands, env)
+        values = [executor(env) for executor in executors]
+        if (tail and isinstance(procedure, LambdaProcedure) and
+                procedure.execute is not None):
+            return TailCall(procedure, values, env)
+        return execute_call(procedure, values, env)
+    if len(executors) == 1:
+        operand = executors[0]
+        def execute(env):
+            procedure = operator(env)
+            if type(procedure) is BuiltinProcedure and procedure.unary is not None:
+                value = operand(env)
+                result = procedure.unary(value)
+                if result is NotImplemented:
+                    return procedure.call([value], env)
+                return result
+            return call(procedure, env)
+    elif len(executors) == 2:
+        first, second = executors
+        def execute(env):
+            procedure = operator(env)
+            if type(procedure) is BuiltinProcedure and procedure.binary is not None:
+                x, y = first(env), second(env)
+                result = procedure.binary(x, y)
+                if result is NotImplemented:
+                    return procedure.call([x, y], env)
+                return result
+            return call(procedure, env)
+    else:
+        def execute(env):
+            return call(operator(env), env)
+    def expand_call(macro, env):
+        # The expansion is analyzed as if in tail position, so that a loop
+        # through a macro call in tail position does not grow the stack.
+        entry = macro.expansion(operands, env)
+        if entry[3] is None:
+            entry[3] = analyze_sequence(entry[1], True, None)
+        result = entry[3](env)
+        if not tail and isinstance(result, TailCall):
+            return execute_call(result.procedure, result.values, result.env)
+        return result
+    return execute
+
+def operands_list(operands):
+    """Return the elements of the Scheme list OPERANDS as a Python list."""
+    if not scheme_listp(operands):
+        raise SchemeError('badly formed expression: ' + repl_str(operands))
+    lst = []
+    while operands is not nil:
+        lst.append(operands.first)
+        operands = operands.rest
+    return lst
+
+def execute_call(procedure, values, env):
+    """Apply PROCEDURE to the Python list VALUES of arguments in ENV, running
+    tail calls from analyzed bodies in a loop."""
+    while True:
+        if isinstance(procedure, LambdaProcedure) and procedure.execute is not None:
+            params = procedure.params
+            if len(values) != len(params):
+                raise SchemeError('requires {0} argument(s) but gets {1}'.format(
+                    len(params), len(values)))
+            if isinstance(procedure, MuProcedure):
+                frame = Frame(env)
+                frame.bindings.update(zip(params, values))
+            else:
+                layout = procedure.layout
+                if len(layout) > len(values):
+                    values = values + [UNASSIGNED] * (len(layout) - len(values))
+                frame = ArrayFrame(procedure.env, layout, values)
+            if PROFILE is None:
+                result = procedure.execute(frame)
+            else:
+                result = PROFILE.call(procedure, procedure.execute, frame)
+            if isinstance(result, TailCall):
+                procedure, values, env = result.procedure, result.values, result.env
+                continue
+            return result
+        elif isinstance(procedure, BuiltinProcedure):
+            return procedure.call(values, env)
+        else:
+            return value_applier(procedure, env)(values)
+
+def analyze_params(formals):
+    """Return the symbols in the Scheme list FORMALS as a tuple."""
+    validate_formals(formals)
+    if not scheme_listp(formals):
+        raise SchemeError('variadic procedures are not supported')
+    return tuple(operands_list(formals))
+
+def analyze_quote(args, tail, scope):
+    check_argument(args, lambda x:x==1)
+    value = args.first
+    return lambda env: value
+
+def analyze_quasiquote(args, tail, scope):
+    build, exprs = compile_quasiquote(args)
+    executes = [analyze(expr, False, scope) for expr in exprs]
+    return lambda env: build(iter([execute(env) for execute in executes]))
+
+def analyze_define(args, tail, scope):
+    check_argument(args, lambda x:x>=2)
+    target = args.first
+    if isinstance(target, Pair):
+        target, value = target.first, analyze_lambda(
+            Pair(target.rest, args.rest), tail, scope)
+    else:
+        value = analyze(args.rest.first, False, scope)
+    if scope is not None and not scope.opaque and target in scope.layout:
+        index = scope.layout[target]
+        def execute(env):
+            env.values[index] = name_procedure(value(env), target)
+            return target
+        return execute
+    return lambda env: env.define(target, name_procedure(value(env), target))
+
+def analyze_lambda(args, tail, scope, procedure_type=LambdaProcedure):
+    check_argument(args, lambda x:x>=2)
+    formals, body = args.first, args.rest
+    params = analyze_params(formals)
+    if procedure_type is MuProcedure:
+        body_scope = Scope(params, body, None, opaque=True)
+    else:
+        body_scope = Scope(params, body, scope)
+    execute = analyze_sequence(body, True, body_scope)
+    layout = body_scope.layout
+    def make_procedure(env):
+        if procedure_type is MuProcedure:
+            procedure = MuProcedure(formals, body)
+        else:
+            procedure = LambdaProcedure(formals, body, env)
+        procedure.params, procedure.layout = params, layout
+        procedure.execute = execute
+        return procedure
+    return make_procedure
+
+def analyze_define_memo(args, tail, scope):
+    return analyze(expand_define_memo(args), tail, scope)
+
+def analyze_delay(args, tail, scope):
+    return analyze(expand_delay(args), tail, scope)
+
+def analyze_cons_stream(args, tail, scope):
+    return analyze(expand_cons_stream(args), tail, scope)
 
+def analyze_mu(args, tail, scope):
+    return analyze_lambda(args, tail, scope, MuProcedure)
 
+def analyze_begin(args, tail, scope):
+    return analyze_sequence(args, tail, scope)
+
+def analyze_if(args, tail, scope):
+    check_argument(args, lambda x:x==3)
+    predicate = analyze(args.first, False, scope)
+    consequent = analyze(args.rest.first, tail, scope)
+    alternative = analyze(args.rest.rest.first, tail, scope)
+    def execute(env):
+        if is_true_primitive(predicate(env)):
+            return consequent(env)
+        return alternative(env)
+    return execute
+
+def analyze_cond(args, tail, scope):
+    clauses = []
+    for clause in operands_list(args):
+        check_argument(clause, lambda x:x>=1)
+        if clause.first == 'else':
+            clauses.append((None, analyze_sequence(clause.rest, tail, scope)))
+            break
+        test = analyze(clause.first, False, scope)
+        if clause.rest is nil:
+            clauses.append((test, None))
+        else:
+            clauses.append((test, analyze_sequence(clause.rest, tail, scope)))
+    clauses = tuple(clauses)
+    def execute(env):
+        for test, body in clauses:
+            if test is None:
+                return body(env)
+            val = test(env)
+            if is_true_primitive(val):
+                if body is None:
+                    return val
+                return body(env)
+        return None
+    return execute
+
+def analyze_and(args, tail, scope):
+    if args is nil:
+        return lambda env: True
+    exprs = operands_list(args)
+    executors = tuple(analyze(expr, False, scope) for expr in exprs[:-1])
+    last = analyze(exprs[-1], tail, scope)
+    def execute(env):
+        for executor in executors:
+            val = executor(env)
+            if is_false_primitive(val):
+                return val
+        return last(env)
+    return execute
+
+def analyze_or(args, tail, scope):
+    if args is nil:
+        return lambda env: False
+    exprs = operands_list(args)
+    executors = tuple(analyze(expr, False, scope) for expr in exprs[:-1])
+    last = analyze(exprs[-1], tail, scope)
+    def execute(env):
+        for executor in executors:
+            val = executor(env)
+            if is_true_primitive(val):
+                return val
+        return last(env)
+    return execute
+
+def analyze_let(args, tail, scope):
+    check_argument(args, lambda x:x>=2)
+    names, values = [], []
+    for binding in operands_list(args.first):
+        check_argument(binding, lambda x:x==2)
+        if not isinstance(binding.first, str):
+            raise SchemeError('illegal name.')
+        names.append(binding.first)
+        values.append(analyze(binding.rest.first, False, scope))
+    body_scope = Scope(names, args.rest, scope)
+    body = analyze_sequence(args.rest, tail, body_scope)
+    layout = body_scope.layout
+    bindings = tuple((layout[name], value) for name, value in zip(names, values))
+    def execute(env):
+        slots = [UNASSIGNED] * len(layout)
+        for index, value in bindings:
+            slots[index] = value(env)
+        return body(ArrayFrame(env, layout, slots))
+    return execute
+
+ANALYZERS = {
+    'quote': analyze_quote,
+    'quasiquote': analyze_quasiquote,
+    'define': analyze_define,
+    'define-memo': analyze_define_memo,
+    'lambda': analyze_lambda,
+    'mu': analyze_mu,
+    'begin': analyze_begin,
+    'if': analyze_if,
+    'cond': analyze_cond,
+    'and': analyze_and,
+    'or': analyze_or,
+    'let': analyze_let,
+    'delay': analyze_delay,
+    'cons-stream': analyze_cons_stream,
+}
+
+###############
+# Bytecode VM #
+###############
+
+# A second alternative to scheme_eval: vm_compile translates an expression
+# into bytecode, an array of ints, with a pool of constants, and vm_run
+# executes it in a single dispatch loop. Calls between compiled procedures
+# push and pop frames of the loop rather than recursing in Python, and tail
+# calls replace the caller's frame. Local names are laid out by the same
+# Scopes as in analyze mode, so calls create ArrayFrames.
+#
+# The frames of the loop are a list on the heap, so recursion between
+# compiled procedures, and through the expansions of macros, which are
+# compiled too, is bounded only by memory. A call made by a builtin, such as
+# stream-map, runs a nested loop, and so does use the Python stack. If
+# MAX_DEPTH is set, a call that would make more calls in progress than that,
+# counting those of every loop, is an error.
+
+MAX_DEPTH = 0  # The most calls in progress on the VM, or 0 for no limit
+VM_STACKS = []  # The frames of each vm_loop that is running, outermost first
+
+# Opcodes, each followed by the number of operands shown
+OP_CONST = 0        # k: push constant k
+OP_LOAD_LOCAL = 1   # i k: push slot i of the current frame, named constant k
+OP_LOAD_ADDR = 2    # k d i: push slot i of the frame d up, named constant k
+OP_LOAD_NAME = 3    # k d: push constant k looked up by name, d frames up
+OP_DEFINE_LOCAL = 4 # k i: pop into slot i, named constant k; push the name
+OP_DEFINE_NAME = 5  # k: pop and define constant k in the frame; push the name
+OP_POP = 6          # discard the top of the stack
+OP_JUMP = 7         # t: continue at t
+OP_JUMP_IF_FALSE = 8  # t: pop; continue at t if the value is false
+OP_AND_JUMP = 9     # t: continue at t if the top is false, else pop it
+OP_OR_JUMP = 10     # t: continue at t if the top is true, else pop it
+OP_CLOSURE = 11     # k: push a procedure made from Template constant k
+OP_MACRO_CHECK = 12 # k t: if the top is a special form, replace it with its
+                    #      application to operands k and continue at t; the
+                    #      call at t - 2 tells whether it is in tail position
+OP_CALL = 13        # n: pop n arguments and a procedure; push the result
+OP_TAIL_CALL = 14   # n: as CALL, returning the result from this frame
+OP_RETURN = 15      # pop the result of this frame and return it
+OP_EVAL = 16        # k: push the value of constant k by scheme_eval
+OP_UNARY = 17       # t: if the procedure under the top is a builtin whose
+                    #    unary fast path handles the top, replace both with
+                    #    its result and continue at t
+OP_BINARY = 18      # t: as UNARY, for the binary fast path and the top two
+
+class CodeObject(object):
+    """Bytecode for an expression or procedure body, and its constants."""
+
+    def __init__(self):
+        self.code = array('i')
+        self.constants = []
+        self.names = {}
+
+    def constant(self, value):
+        """Return the index of VALUE in the constant pool, adding it if it is
+        not a name that is already there."""
+        if isinstance(value, str):
+            if value not in self.names:
+                self.names[value] = len(self.constants)
+                self.constants.append(value)
+            return self.names[value]
+        self.constants.append(value)
+        return len(self.constants) - 1
+
+    def emit(self, *words):
+        self.code.extend(words)
+
+class Template(object):
+    """What OP_CLOSURE needs to make a procedure from a lambda or mu."""
+
+    def __init__(self, formals, body, params, layout, code, mu):
+        self.formals = formals
+        self.body = body
+        self.params = params
+        self.layout = layout
+        self.code = code
+        self.mu = mu
+
+def vm_eval(expr, env):
+    """Evaluate EXPR in ENV by compiling it to bytecode and running it.
+
+    >>> vm_eval(read_line('((lambda (x) (* x x)) 7)'), create_global_frame())
+    49
+    """
+    code = CodeObject()
+    vm_compile(expr, code, True)
+    code.emit(OP_RETURN)
+    try:
+        return vm_run(code, env)
+    except AttributeError as err:
+        raise SchemeError(err)
+    except RecursionError:  # Through calls made by builtins
+        raise SchemeError('maximum recursion depth exceeded')
+
+def vm_apply(procedure, values, env):
+    """Apply the compiled PROCEDURE to the Python list VALUES in ENV."""
+    return vm_run(procedure.code, vm_frame(procedure, values, env), procedure)
+
+def vm_frame(procedure, values, env):
+    """Return the frame for a call to the compiled PROCEDURE with VALUES,
+    made in ENV."""
+    params = procedure.params
+    if len(values) != len(params):
+        raise SchemeError('requires {0} argument(s) but gets {1}'.format(
+            len(params), len(values)))
+    if isinstance(procedure, MuProcedure):
+        frame = Frame(env)
+        frame.bindings.update(zip(params, values))
+        return frame
+    layout = procedure.layout
+    if len(layout) > len(values):
+        values = values + [UNASSIGNED] * (len(layout) - len(values))
+    return ArrayFrame(procedure.env, layout, values)
+
+def vm_run(code_object, env, procedure=None):
+    """Run CODE_OBJECT in ENV and return the value it returns. PROCEDURE is
+    the compiled procedure that CODE_OBJECT is the body of, if any."""
+    frames = []
+    limit = sys.maxsize
+    if MAX_DEPTH:
+        limit = MAX_DEPTH - sum(len(outer) + 1 for outer in VM_STACKS) - 1
+        if limit < 0:
+            raise depth_error()
+    VM_STACKS.append(frames)
+    try:
+        if PROFILE is None:
+            return vm_loop(code_object, env, frames, limit, None, 0)
+        depth = PROFILE.depth()
+        if procedure is not None:
+            PROFILE.enter(procedure)
+        try:
+            return vm_loop(code_object, env, frames, limit, PROFILE, depth)
+        finally:
+            PROFILE.unwind(depth)
+    finally:
+        VM_STACKS.pop()
+
+def depth_error():
+    return SchemeError('maximum recursion depth exceeded ({0} calls)'.format(
+        MAX_DEPTH))
+
+def vm_loop(code_object, env, frames, limit, profile, depth):
+    """The dispatch loop of vm_run, which keeps the frames of the calls it
+    makes in the list FRAMES, and pushes at most LIMIT of them. Unless
+    PROFILE is None, each call that the loop makes to a compiled procedure
+    is entered in it, above the first DEPTH calls in progress.
+
+    The expansion of a macro call in tail position replaces the frame of the
+    call, so a loop through one does not count towards LIMIT.
+
+    >>> env = create_global_frame()
+    >>> for line in ["(define-macro (when c body) `(if ,c ,body 'done))",
+    ...              '(define (loop n) (when (> n 0) (loop (- n 1))))']:
+    ...     _ = vm_eval(read_line(line), env)
+    >>> code = CodeObject()
+    >>> vm_compile(read_line('(loop 5000)'), code, True)
+    >>> code.emit(OP_RETURN)
+    >>> vm_loop(code, env, [], 10, None, 0)
+    'done'
+    """
+    stack = []
+    code, constants, pc = code_object.code, code_object.constants, 0
+    while True:
+        op = code[pc]
+        if op == OP_LOAD_LOCAL:
+            value = env.values[code[pc + 1]]
+            if value is UNASSIGNED:
+                value = env.parent.lookup(constants[code[pc + 2]])
+            stack.append(value)
+            pc += 3
+        elif op == OP_CONST:
+            stack.append(constants[code[pc + 1]])
+            pc += 2
+        elif op == OP_LOAD_NAME:
+            name, frame = constants[code[pc + 1]], env
+            for _ in range(code[pc + 2]):
+                if frame.bindings is not None and name in frame.bindings:
+                    break
+                frame = frame.parent
+            if frame.layout is None and name in frame.bindings:
+                stack.append(frame.bindings[name])
+            elif frame.parent is BASE_FRAME and name in BASE_FRAME.bindings:
+                stack.append(BASE_FRAME.bindings[name])
+            else:
+                stack.append(frame.lookup(name))
+            pc += 3
+        elif op == OP_MACRO_CHECK:
+            procedure = stack[-1]
+            if type(procedure) is MacroProcedure and profile is None:
+                entry = procedure.expansion(constants[code[pc + 1]], env)
+                if entry[2] is None:
+                    entry[2] = vm_compile_expansion(entry[1])
+                stack.pop()
+                if code[code[pc + 2] - 2] != OP_TAIL_CALL:
+                    if len(frames) >= limit:
+                        raise depth_error()
+                    frames.append((code, constants, code[pc + 2], env))
+                code, constants, pc = entry[2].code, entry[2].constants, 0
+            elif isinstance(procedure, SpecialForm):
+                stack[-1] = scheme_apply(procedure, constants[code[pc + 1]], env)
+                pc = code[pc + 2]
+            else:
+                pc += 3
+        elif op == OP_BINARY:
+            procedure = stack[-3]
+            if type(procedure) is BuiltinProcedure and procedure.binary is not None:
+                value = procedure.binary(stack[-2], stack[-1])
+                if value is not NotImplemented:
+                    del stack[-3:]
+                    stack.append(value)
+                    pc = code[pc + 1]
+                    continue
+            pc += 2
+        elif op == OP_UNARY:
+            procedure = stack[-2]
+            if type(procedure) is BuiltinProcedure and procedure.unary is not None:
+                value = procedure.unary(stack[-1])
+                if value is not NotImplemented:
+                    del stack[-2:]
+                    stack.append(value)
+                    pc = code[pc + 1]
+                    continue
+            pc += 2
+        elif op == OP_CALL or op == OP_TAIL_CALL:
+            n = code[pc + 1]
+            values = stack[len(stack) - n:]
+            del stack[len(stack) - n:]
+            procedure = stack.pop()
+            if isinstance(procedure, LambdaProcedure) and procedure.code is not None:
+                if op == OP_CALL:
+                    if len(frames) >= limit:
+                        raise depth_error()
+                    frames.append((code, constants, pc + 2, env))
+                env = vm_frame(procedure, values, env)
+                if profile is None:
+                    pass
+                elif op == OP_CALL:
+                    profile.enter(procedure)
+                else:
+                    profile.switch(procedure, depth)
+                code_object = procedure.code
+                code, constants, pc = code_object.code, code_object.constants, 0
+                continue
+            if isinstance(procedure, BuiltinProcedure):
+                value = procedure.call(values, env)
+            else:
+                value = execute_call(procedure, values, env)
+            if op == OP_CALL:
+                stack.append(value)
+                pc += 2
+            elif frames:
+                code, constants, pc, env = frames.pop()
+                stack.append(value)
+                if profile is not None:
+                    profile.leave()
+            else:
+                return value
+        elif op == OP_JUMP_IF_FALSE:
+            if stack.pop() is False:
+                pc = code[pc + 1]
+            else:
+                pc += 2
+        elif op == OP_RETURN:
+            if not frames:
+                return stack.pop()
+            code, constants, pc, env = frames.pop()
+            if profile is not None:
+                profile.leave()
+        elif op == OP_JUMP:
+            pc = code[pc + 1]
+        elif op == OP_LOAD_ADDR:
+            name, frame = constants[code[pc + 1]], env
+            for _ in range(code[pc + 2]):
+                if frame.bindings is not None and name in frame.bindings:
+                    value = frame.bindings[name]
+                    break
+                frame = frame.parent
+            else:
+                value = frame.values[code[pc + 3]]
+                if value is UNASSIGNED:
+                    value = frame.parent.lookup(name)
+            stack.append(value)
+            pc += 4
+        elif op == OP_POP:
+            stack.pop()
+            pc += 1
+        elif op == OP_AND_JUMP:
+            if stack[-1] is False:
+                pc = code[pc + 1]
+            else:
+                stack.pop()
+                pc += 2
+        elif op == OP_OR_JUMP:
+            if stack[-1] is not False:
+                pc = code[pc + 1]
+            else:
+                stack.pop()
+                pc += 2
+        elif op == OP_DEFINE_LOCAL:
+            name = constants[code[pc + 1]]
+            env.values[code[pc + 2]] = name_procedure(stack.pop(), name)
+            stack.append(name)
+            pc += 3
+        elif op == OP_DEFINE_NAME:
+            name = constants[code[pc + 1]]
+            stack.append(env.define(name, name_procedure(stack.pop(), name)))
+            pc += 2
+        elif op == OP_CLOSURE:
+            template = constants[code[pc + 1]]
+            if template.mu:
+                procedure = MuProcedure(template.formals, template.body)
+            else:
+                procedure = LambdaProcedure(template.formals, template.body, env)
+            procedure.params, procedure.layout = template.params, template.layout
+            procedure.code = template.code
+            stack.append(procedure)
+            pc += 2
+        elif op == OP_EVAL:
+            stack.append(scheme_eval(constants[code[pc + 1]], env))
+            pc += 2
+        else:
+            raise SchemeError('bad opcode {0}'.format(op))
+
+def vm_compile(expr, code, tail=False, scope=None):
+    """Append to CODE the bytecode that pushes the value of EXPR. If TAIL,
+    EXPR is in tail position and calls are compiled as tail calls. SCOPE is
+    as for analyze."""
+    if isinstance(expr, Pair):
+        first = expr.first
+        if isinstance(first, Symbol) and first.special:
+            compiler = VM_COMPILERS.get(first)
+            args = (expr.rest, code, tail, scope)
+        else:
+            compiler = vm_compile_call
+            args = (expr, code, tail, scope)
+        if compiler is not None:
+            start = len(code.code)
+            try:
+                return compiler(*args)
+            except SchemeError:
+                del code.code[start:]  # Ill-formed; report the error when run
+        code.emit(OP_EVAL, code.constant(expr))
+    elif isinstance(expr, str):
+        if isinstance(expr, Symbol) and expr.special:
+            code.emit(OP_CONST, code.constant(SPECIAL_FORMS[expr]))
+        else:
+            vm_compile_symbol(expr, code, scope)
+    else:
+        code.emit(OP_CONST, code.constant(expr))
+
+def vm_compile_symbol(name, code, scope):
+    depth = 0
+    while scope is not None and not scope.opaque:
+        if name in scope.layout:
+            if depth == 0:
+                code.emit(OP_LOAD_LOCAL, scope.layout[name], code.constant(name))
+            else:
+                code.emit(OP_LOAD_ADDR, code.constant(name), depth, scope.layout[name])
+            return
+        scope, depth = scope.parent, depth + 1
+    code.emit(OP_LOAD_NAME, code.constant(name), depth)
+
+def vm_compile_sequence(exprs, code, tail, scope):
+    check_argument(exprs, lambda x:x>=1)
+    while exprs.rest is not nil:
+        vm_compile(exprs.first, code, False, scope)
+        code.emit(OP_POP)
+        exprs = exprs.rest
+    vm_compile(exprs.first, code, tail, scope)
+
+def vm_compile_call(expr, code, tail, scope):
+    operands = expr.rest
+    exprs = operands_list(operands)
+    vm_compile(expr.first, code, False, scope)
+    code.emit(OP_MACRO_CHECK, code.constant(operands), 0)
+    target = len(code.code) - 1
+    for operand in exprs:
+        vm_compile(operand, code, False, scope)
+    if len(exprs) in (1, 2):
+        code.emit(OP_UNARY if len(exprs) == 1 else OP_BINARY, len(code.code) + 4)
+    code.emit(OP_TAIL_CALL if tail else OP_CALL, len(exprs))
+    code.code[target] = len(code.code)
+
+def vm_compile_expansion(body):
+    """Return a CodeObject that evaluates BODY, the expansion of a macro
+    call, in the frame of the call, and returns its value."""
+    code = CodeObject()
+    vm_compile_sequence(body, code, True, None)
+    code.emit(OP_RETURN)
+    return code
+
+def vm_compile_template(formals, body, params, scope, mu=False):
+    """Return a Template for a procedure with FORMALS and BODY whose frames
+    bind PARAMS, defined in SCOPE."""
+    if mu:
+        body_scope = Scope(params, body, None, opaque=True)
+    else:
+        body_scope = Scope(params, body, scope)
+    body_code = CodeObject()
+    vm_compile_sequence(body, body_code, True, body_scope)
+    body_code.emit(OP_RETURN)
+    return Template(formals, body, params, body_scope.layout, body_code, mu)
+
+def vm_compile_quote(args, code, tail, scope):
+    check_argument(args, lambda x:x==1)
+    code.emit(OP_CONST, code.constant(args.first))
+
+def vm_compile_quasiquote(args, code, tail, scope):
+    build, exprs = compile_quasiquote(args)
+    if not exprs:
+        code.emit(OP_CONST, code.constant(build(None)))
+        return
+    builder = BuiltinProcedure(lambda *values: build(iter(values)), name='quasiquote')
+    vm_compile(Pair(builder, Pair.from_iterable(exprs)), code, tail, scope)
+
+def vm_compile_define(args, code, tail, scope):
+    check_argument(args, lambda x:x>=2)
+    target = args.first
+    if isinstance(target, Pair):
+        target = target.first
+        vm_compile_lambda(Pair(args.first.rest, args.rest), code, False, scope)
+    else:
+        vm_compile(args.rest.first, code, False, scope)
+    if scope is not None and not scope.opaque and target in scope.layout:
+        code.emit(OP_DEFINE_LOCAL, code.constant(target), scope.layout[target])
+    else:
+        code.emit(OP_DEFINE_NAME, code.constant(target))
+
+def vm_compile_define_memo(args, code, tail, scope):
+    vm_compile(expand_define_memo(args), code, tail, scope)
+
+def vm_compile_delay(args, code, tail, scope):
+    vm_compile(expand_delay(args), code, tail, scope)
+
+def vm_compile_cons_stream(args, code, tail, scope):
+    vm_compile(expand_cons_stream(args), code, tail, scope)
+
+def vm_compile_lambda(args, code, tail, scope, mu=False):
+    check_argument(args, lambda x:x>=2)
+    formals, body = args.first, args.rest
+    template = vm_compile_template(formals, body, analyze_params(formals), scope, mu)
+    code.emit(OP_CLOSURE, code.constant(template))
+
+def vm_compile_mu(args, code, tail, scope):
+    vm_compile_lambda(args, code, tail, scope, mu=True)
+
+def vm_compile_begin(args, code, tail, scope):
+    vm_compile_sequence(args, code, tail, scope)
+
+def vm_compile_if(args, code, tail, scope):
+    check_argument(args, lambda x:x==3)
+    vm_compile(args.first, code, False, scope)
+    code.emit(OP_JUMP_IF_FALSE, 0)
+    alternative = len(code.code) - 1
+    vm_compile(args.rest.first, code, tail, scope)
+    code.emit(OP_JUMP, 0)
+    end = len(code.code) - 1
+    code.code[alternative] = len(code.code)
+    vm_compile(args.rest.rest.first, code, tail, scope)
+    code.code[end] = len(code.code)
+
+def vm_compile_cond(args, code, tail, scope):
+    ends = []
+    for clause in operands_list(args):
+        check_argument(clause, lambda x:x>=1)
+        if clause.first == 'else':
+            vm_compile_sequence(clause.rest, code, tail, scope)
+            break
+        vm_compile(clause.first, code, False, scope)
+        if clause.rest is nil:
+            code.emit(OP_OR_JUMP, 0)
+        else:
+            code.emit(OP_JUMP_IF_FALSE, 0)
+            next_clause = len(code.code) - 1
+            vm_compile_sequence(clause.rest, code, tail, scope)
+            code.emit(OP_JUMP, 0)
+            ends.append(len(code.code) - 1)
+            code.code[next_clause] = len(code.code)
+            continue
+        ends.append(len(code.code) - 1)
+    else:
+        code.emit(OP_CONST, code.constant(None))
+    for end in ends:
+        code.code[end] = len(code.code)
+
+def vm_compile_and(args, code, tail, scope, jump=OP_AND_JUMP, empty=True):
+    exprs = operands_list(args)
+    if not exprs:
+        code.emit(OP_CONST, code.constant(empty))
+        return
+    ends = []
+    for expr in exprs[:-1]:
+        vm_compile(expr, code, False, scope)
+        code.emit(jump, 0)
+        ends.append(len(code.code) - 1)
+    vm_compile(exprs[-1], code, tail, scope)
+    for end in ends:
+        code.code[end] = len(code.code)
+
+def vm_compile_or(args, code, tail, scope):
+    vm_compile_and(args, code, tail, scope, OP_OR_JUMP, False)
+
+def vm_compile_let(args, code, tail, scope):
+    """Compile a let as a call to a procedure whose frame binds its names."""
+    check_argument(args, lambda x:x>=2)
+    names, values = [], []
+    for binding in operands_list(args.first):
+        check_argument(binding, lambda x:x==2)
+        if not isinstance(binding.first, str) or binding.first in names:
+            raise SchemeError('bad let binding: {0}'.format(binding))
+        names.append(binding.first)
+        values.append(binding.rest.first)
+    template = vm_compile_template(args.first, args.rest, tuple(names), scope)
+    code.emit(OP_CLOSURE, code.constant(template))
+    for value in values:
+        vm_compile(value, code, False, scope)
+    code.emit(OP_TAIL_CALL if tail else OP_CALL, len(values))
+
+VM_COMPILERS = {
+    'quote': vm_compile_quote,
+    'quasiquote': vm_compile_quasiquote,
+    'define': vm_compile_define,
+    'define-memo': vm_compile_define_memo,
+    'lambda': vm_compile_lambda,
+    'mu': vm_compile_mu,
+    'begin': vm_compile_begin,
+    'if': vm_compile_if,
+    'cond': vm_compile_cond,
+    'and': vm_compile_and,
+    'or': vm_compile_or,
+    'let': vm_compile_let,
+    'delay': vm_compile_delay,
+    'cons-stream': vm_compile_cons_stream,
+}
+
+####################
+# Constant Folding #
+####################
+
+# With --fold, each expression read at the top level is rewritten before it
+# is evaluated: calls of pure builtins on literals are replaced by their
+# values, an if or cond whose test is a literal by the branch it takes, and
+# a let binding of a literal by the literal wherever the name is referenced.
+# Each rewrite is reported on stderr.
+#
+# A call of a builtin is folded only where it is evaluated as soon as the
+# top-level expression is, and not in the body of a procedure or promise,
+# which could run after its name is defined again. It is not folded if the
+# global frame or an enclosing scope binds its name. Macro operands and mu
+# bodies are left alone, since their names are not resolved where they
+# appear, and so is a let whose body could reach its names by other means
+# than a reference to them.
+
+FOLD = False  # Whether scheme_load folds files loaded into the global frame
+
+# The builtins that are folded, which have no effects and depend only on
+# their arguments
+PURE_BUILTINS = frozenset(['+', '-', '*', '/', 'quotient', 'modulo',
+                           'remainder', 'abs', 'expt', '=', '<', '>', '<=',
+                           '>=', 'even?', 'odd?', 'zero?', 'not', 'number?',
+                           'integer?', 'boolean?', 'null?'])
+
+FOLDABLE = dict((name, fn) for name, fn, _ in BUILTINS if name in PURE_BUILTINS)
+
+def fold_literal(expr):
+    """Whether EXPR is a number, boolean or nil, which evaluates to itself."""
+    return scheme_numberp(expr) or scheme_booleanp(expr) or expr is nil
+
+def fold_constant(expr):
+    """Whether EXPR always evaluates to the same value without effects."""
+    return fold_literal(expr) or (isinstance(expr, Pair) and expr.first == 'quote'
+                                  and isinstance(expr.rest, Pair)
+                                  and expr.rest.rest is nil)
+
+def fold_constant_value(expr):
+    return expr.rest.first if isinstance(expr, Pair) else expr
+
+def fold_str(expr, width=60):
+    """Return EXPR as printed, shortened to about WIDTH characters."""
+    text = repl_str(expr)
+    return text if len(text) <= width else text[:width - 3] + '...'
+
+def formal_names(formals):
+    """Return the names bound by the formal parameter list FORMALS."""
+    names = []
+    while isinstance(formals, Pair):
+        names.append(formals.first)
+        formals = formals.rest
+    if isinstance(formals, str):
+        names.append(formals)
+    return names
+
+class Folder(object):
+    """Folds expressions to be evaluated in the global frame ENV, reporting
+    each rewrite by calling REPORT with a message."""
+
+    def __init__(self, env, report=None):
+        self.env = env
+        self.report = report or (lambda message: print('fold:', message,
+                                                       file=sys.stderr))
+        self.later = 0  # How many procedure or promise bodies EXPR is in
+        self.defined = set()  # Names defined by the expressions folded so far
+        self.dynamic = set()  # Those that may be macros or mu procedures
+
+    def reader(self, read):
+        """Return a function like READ that folds what READ returns."""
+        return lambda src: self.fold_top(read(src))
+
+    def fold_top(self, expr):
+        """Return EXPR, a top-level expression, folded.
+
+        >>> folder = Folder(create_global_frame(), print)
+        >>> print(folder.fold_top(read_line('(define x (if (< 1 2) (* 4 (+ 2 3)) 0))')))
+        (< 1 2) -> #t
+        (+ 2 3) -> 5
+        (* 4 5) -> 20
+        (if #t 20 0) -> 20
+        (define x 20)
+        >>> print(folder.fold_top(read_line('(define (f x) (if #t (* x (+ 2 3)) 0))')))
+        (if #t (* x (+ 2 3)) 0) -> (* x (+ 2 3))
+        (define (f x) (* x (+ 2 3)))
+        >>> print(folder.fold_top(read_line('(let ((y 4) (z (car s))) (+ y z))')))
+        (let ((y 4) (z (car s))) (+ y z)) -> inlined y
+        (let ((z (car s))) (+ 4 z))
+        """
+        names = defined_names(Pair(expr, nil))
+        # Expressions may be read before the ones before them are evaluated,
+        # so their definitions are not yet in the global frame.
+        self.defined.update(names)
+        if names and mentioned_names([expr]) & {'mu', 'define-macro'}:
+            self.dynamic.update(names)
+        return self.fold(expr, frozenset(self.defined))
+
+    def rewrite(self, expr, result):
+        """Report that EXPR is rewritten to RESULT, and return RESULT."""
+        self.report('{0} -> {1}'.format(fold_str(expr), fold_str(result)))
+        return result
+
+    def fold(self, expr, bound):
+        """Return EXPR folded, where BOUND is the names bound around it other
+        than in the global frame. EXPR itself is returned if nothing in it
+        is folded."""
+        if not isinstance(expr, Pair) or not scheme_listp(expr):
+            return expr
+        first = expr.first
+        if isinstance(first, Symbol) and first.special:
+            method = getattr(self, 'fold_' + FOLD_FORMS.get(first, 'none'))
+            return method(expr, bound)
+        if self.macro(first, bound):
+            return expr
+        exprs = [self.fold(item, bound) for item in expr.to_list()]
+        if any(new is not old for new, old in zip(exprs, expr.to_list())):
+            expr = Pair.from_iterable(exprs)
+        name, operands = exprs[0], exprs[1:]
+        if (not self.later and isinstance(name, Symbol) and name in FOLDABLE and
+                name not in bound and
+                all(fold_literal(operand) for operand in operands) and
+                self.env.lookup(name) is BASE_FRAME.bindings.get(name)):
+            try:
+                value = FOLDABLE[name](*operands)
+            except (SchemeError, ArithmeticError, TypeError, ValueError):
+                return expr  # Left to report the error when it is evaluated
+            if fold_literal(value):
+                return self.rewrite(expr, value)
+        return expr
+
+    def macro(self, name, bound):
+        """Whether NAME is the name of a macro where it appears."""
+        if not isinstance(name, Symbol) or name in bound:
+            return False
+        if name in self.dynamic:
+            return True
+        try:
+            return isinstance(self.env.lookup(name), MacroProcedure)
+        except SchemeError:
+            return False
+
+    def fold_all(self, exprs, bound):
+        """Fold each expression in the Scheme list EXPRS."""
+        items = exprs.to_list()
+        folded = [self.fold(item, bound) for item in items]
+        if all(new is old for new, old in zip(folded, items)):
+            return exprs
+        return Pair.from_iterable(folded)
+
+    def fold_none(self, expr, bound):
+        return expr
+
+    def fold_operands(self, expr, bound):
+        """Fold the operands of a special form that evaluates them all in
+        the frame it is in, such as begin."""
+        rest = self.fold_all(expr.rest, bound)
+        return expr if rest is expr.rest else Pair(expr.first, rest)
+
+    def fold_body(self, body, names, bound):
+        """Fold BODY, the body of a procedure or let that binds NAMES."""
+        inner = bound.union(names, defined_names(body))
+        return self.fold_all(body, inner)
+
+    def fold_later(self, method, *args):
+        """Return the result of METHOD called with ARGS, folding code that
+        is not evaluated until later."""
+        self.later += 1
+        try:
+            return method(*args)
+        finally:
+            self.later -= 1
+
+    def fold_promise(self, expr, bound):
+        return self.fold_later(self.fold_operands, expr, bound)
+
+    def fold_define(self, expr, bound):
+        if len(expr) < 3:
+            return expr
+        target = expr.rest.first
+        if isinstance(target, Pair):
+            body = self.fold_later(self.fold_body, expr.rest.rest,
+                                   formal_names(target.rest), bound)
+        else:
+            body = self.fold_all(expr.rest.rest, bound)
+        if body is expr.rest.rest:
+            return expr
+        return Pair(expr.first, Pair(target, body))
+
+    def fold_lambda(self, expr, bound):
+        if len(expr) < 3:
+            return expr
+        formals, body = expr.rest.first, expr.rest.rest
+        folded = self.fold_later(self.fold_body, body, formal_names(formals), bound)
+        if folded is body:
+            return expr
+        return Pair(expr.first, Pair(formals, folded))
+
+    def fold_if(self, expr, bound):
+        if len(expr) != 4:
+            return expr
+        folded = self.fold_operands(expr, bound)
+        test, consequent, alternative = folded.rest.to_list()
+        if fold_constant(test):
+            if fold_constant_value(test) is False:
+                return self.rewrite(folded, alternative)
+            return self.rewrite(folded, consequent)
+        return folded
+
+    def fold_cond(self, expr, bound):
+        clauses = expr.rest.to_list()
+        if not all(isinstance(clause, Pair) and scheme_listp(clause)
+                   for clause in clauses):
+            return expr
+        kept, changed = [], False
+        for clause in clauses:
+            if clause.first == 'else':
+                rest = clause.rest
+                folded = clause if rest is nil else Pair(clause.first, self.fold_all(rest, bound))
+                constant, value = True, True
+            else:
+                folded = self.fold_all(clause, bound)
+                constant = fold_constant(folded.first)
+                value = constant and fold_constant_value(folded.first)
+            changed = changed or folded is not clause
+            if constant and value is False:
+                changed = True
+                continue  # Never taken
+            kept.append(folded)
+            if constant:
+                changed = changed or len(kept) < len(clauses)
+                break  # Always taken if reached
+        if not changed:
+            return expr
+        if kept and (kept[0].first == 'else' or fold_constant(kept[0].first)):
+            if kept[0].rest is nil:
+                value = True if kept[0].first == 'else' else kept[0].first
+                return self.rewrite(expr, value)
+            return self.rewrite(expr, Pair(intern('begin'), kept[0].rest))
+        result = Pair(expr.first, Pair.from_iterable(kept))
+        if len(kept) < len(clauses):
+            return self.rewrite(expr, result)
+        return result
+
+    def fold_let(self, expr, bound):
+        if len(expr) < 3 or not scheme_listp(expr.rest.first):
+            return expr
+        bindings, body = expr.rest.first.to_list(), expr.rest.rest
+        if not all(isinstance(b, Pair) and scheme_listp(b) and len(b) == 2 and
+                   isinstance(b.first, Symbol) for b in bindings):
+            return expr
+        values = [self.fold(b.rest.first, bound) for b in bindings]
+        names = [b.first for b in bindings]
+        local = defined_names(body)
+        inline = dict((name, value) for name, value in zip(names, values)
+                      if fold_constant(value) and name not in local)
+        if inline and not self.opaque(body, bound):
+            body = self.substitute(body, inline, bound)
+            inlined = [name for name in names if name in inline]
+            for name in list(inlined):
+                if name in mentioned_names([body]):
+                    inlined.remove(name)  # Still referred to some other way
+            kept = [(name, value) for name, value in zip(names, values)
+                    if name not in inlined]
+        else:
+            inlined, kept = [], list(zip(names, values))
+        body = self.fold_body(body, [name for name, _ in kept], bound)
+        if inlined:
+            self.report('{0} -> inlined {1}'.format(fold_str(expr), ' '.join(inlined)))
+        if not kept and not local:
+            return Pair(intern('begin'), body)
+        if (not inlined and body is expr.rest.rest and
+                all(value is b.rest.first for value, b in zip(values, bindings))):
+            return expr
+        new_bindings = Pair.from_iterable([scheme_list(name, value)
+                                           for name, value in kept])
+        return Pair(expr.first, Pair(new_bindings, body))
+
+    def opaque(self, body, bound):
+        """Whether the names bound around BODY may be reached from it other
+        than by references: by mu, eval or a macro, or by a procedure with
+        dynamic scope that it calls."""
+        for name in mentioned_names([body]):
+            if name in ('mu', 'eval', 'define-macro', 'quasiquote', 'load'):
+                return True
+            if name in self.dynamic:
+                return True
+            if name in bound or not isinstance(name, Symbol) or name.special:
+                continue
+            try:
+                value = self.env.lookup(name)
+            except SchemeError:
+                continue
+            if isinstance(value, (MuProcedure, MacroProcedure)):
+                return True
+        return False
+
+    def substitute(self, expr, values, bound):
+        """Return EXPR with each reference to a name in the dict VALUES
+        replaced by its value, where the name is not bound again."""
+        if isinstance(expr, Symbol):
+            return values.get(expr, expr)
+        if not isinstance(expr, Pair) or not scheme_listp(expr):
+            return expr
+        first = expr.first
+        if first == 'quote':
+            return expr
+        elif first in ('lambda', 'define', 'define-memo') and len(expr) >= 3:
+            target = expr.rest.first
+            if first == 'lambda' or isinstance(target, Pair):
+                formals = target if first == 'lambda' else target.rest
+                shadowed = set(formal_names(formals)) | set(defined_names(expr.rest.rest))
+                inner = dict((k, v) for k, v in values.items() if k not in shadowed)
+                body = self.substitute_all(expr.rest.rest, inner, bound)
+                return Pair(first, Pair(target, body))
+            return Pair(first, Pair(target, self.substitute_all(expr.rest.rest, values, bound)))
+        elif first == 'let' and len(expr) >= 3 and scheme_listp(expr.rest.first):
+            bindings = expr.rest.first.to_list()
+            if not all(isinstance(b, Pair) and scheme_listp(b) for b in bindings):
+                return expr
+            shadowed = set(b.first for b in bindings) | set(defined_names(expr.rest.rest))
+            inner = dict((k, v) for k, v in values.items() if k not in shadowed)
+            bindings = Pair.from_iterable([Pair(b.first, self.substitute_all(b.rest, values, bound))
+                                           for b in bindings])
+            return Pair(first, Pair(bindings, self.substitute_all(expr.rest.rest, inner, bound)))
+        elif first == 'cond':
+            return Pair(first, expr.rest.map(
+                lambda clause: self.substitute_all(clause, values, bound)
+                if isinstance(clause, Pair) and scheme_listp(clause) else clause))
+        elif isinstance(first, Symbol) and first.special:
+            return Pair(first, self.substitute_all(expr.rest, values, bound))
+        return self.substitute_all(expr, values, bound)
+
+    def substitute_all(self, exprs, values, bound):
+        return exprs.map(lambda expr: self.substitute(expr, values, bound))
+
+# The method of Folder that folds each special form, after fold_
+FOLD_FORMS = {
+    'define': 'define',
+    'define-memo': 'define',
+    'lambda': 'lambda',
+    'begin': 'operands',
+    'and': 'operands',
+    'or': 'operands',
+    'delay': 'promise',
+    'cons-stream': 'promise',
+    'if': 'if',
+    'cond': 'cond',
+    'let': 'let',
+}
+
+#############
+# Profiling #
+#############
+
+# With --profile, run installs a Profile as PROFILE. Builtin calls, special
+# form dispatches and frame allocations are counted by wrapping the methods
+# and analyzers they go through. Lambda procedures are called by the
+# trampoline in scheme_apply, by execute_call and by the VM without a Python
+# call of their own, so those check PROFILE themselves. Nothing is wrapped
+# while no Profile is installed.
+
+PROFILE = None  # The installed Profile, if any
+
+class ProfileRecord(object):
+    """The calls to the procedures with a lambda or builtin in common: how
+    many there were, and the seconds spent in them, including the calls that
+    they made, until they returned or made a tail call. PROCEDURE is the
+    first of them called."""
+    __slots__ = ('procedure', 'calls', 'time', 'active')
+
+    def __init__(self, procedure):
+        self.procedure = procedure
+        self.calls = 0
+        self.time = 0.0
+        self.active = 0  # Calls in progress; only the outermost is timed
+
+    @property
+    def name(self):
+        procedure = self.procedure
+        if isinstance(procedure, LambdaProcedure) and procedure.name is None:
+            text = str(procedure)
+            return text if len(text) <= 40 else text[:37] + '...'
+        return str(procedure.name)
+
+    @property
+    def kind(self):
+        return type(self.procedure).__name__
+
+class Profile(object):
+    """The calls of each procedure, and the dispatches on each special form
+    and allocations of each type of frame, made while it is installed. Lambda
+    procedures are profiled by the lambda they were made from, and named as
+    they were first defined. In analyze and VM modes, special forms are
+    dispatched on when they are compiled.
+
+    >>> profile = Profile().install()
+    >>> env = create_global_frame()
+    >>> scheme_eval(read_line('(define (f x) (if (= x 0) 0 (f (- x 1))))'), env)
+    'f'
+    >>> scheme_eval(read_line('(f 3)'), env)
+    0
+    >>> profile.uninstall()
+    >>> sorted((record.name, record.calls) for record in profile.records.values())
+    [('-', 3), ('=', 4), ('f', 4)]
+    >>> profile.forms['if'], profile.frames['Frame']
+    (4, 5)
+    """
+
+    def __init__(self):
+        self.records = {}
+        self.forms = {}
+        self.frames = {}
+        self.stack = []  # (record, start time) for each call in progress
+        self.originals = []
+
+    def install(self):
+        """Make SELF the installed Profile, and return it."""
+        global PROFILE
+        profile = self
+        def patch(owner, name, wrapper):
+            if isinstance(owner, dict):
+                self.originals.append((owner, name, owner[name]))
+                owner[name] = wrapper
+            elif isinstance(owner, type):
+                self.originals.append((owner, name, owner.__dict__[name]))
+                setattr(owner, name, wrapper)
+            else:
+                self.originals.append((owner, name, getattr(owner, name)))
+                setattr(owner, name, wrapper)
+        def counter(fn, counts, key):
+            def wrapper(*args):
+                name = key(*args)
+                counts[name] = counts.get(name, 0) + 1
+                return fn(*args)
+            return wrapper
+
+        builtin_call = BuiltinProcedure.call
+        def call(procedure, *args):
+            return profile.call(procedure, builtin_call, procedure, *args)
+        patch(BuiltinProcedure, 'call', call)
+        builtin_init = BuiltinProcedure.__init__
+        def init(procedure, *args, **kwargs):
+            builtin_init(procedure, *args, **kwargs)
+            procedure.unary = procedure.binary = None  # So calls are counted
+        patch(BuiltinProcedure, '__init__', init)
+        for value in BASE_FRAME.bindings.values():
+            if isinstance(value, BuiltinProcedure):
+                patch(value, 'unary', None)
+                patch(value, 'binary', None)
+        for cls in (SpecialForm, MacroProcedure):
+            patch(cls, 'apply', counter(cls.apply, self.forms,
+                                        lambda form, *args: form.name))
+        for cls in (Frame, ArrayFrame):
+            patch(cls, '__init__', counter(cls.__init__, self.frames,
+                                           lambda frame, *args: type(frame).__name__))
+        for table in (ANALYZERS, VM_COMPILERS):
+            for name, compiler in list(table.items()):
+                patch(table, name, counter(compiler, self.forms,
+                                           lambda *args, name=name: name))
+        PROFILE = self
+        return self
+
+    def uninstall(self):
+        """Undo install."""
+        global PROFILE
+        for owner, name, original in reversed(self.originals):
+            if isinstance(owner, dict):
+                owner[name] = original
+            else:
+                setattr(owner, name, original)
+        self.originals = []
+        PROFILE = None
+
+    def enter(self, procedure):
+        """Start a call to PROCEDURE."""
+        if isinstance(procedure, LambdaProcedure):
+            key = id(procedure.body)
+        else:
+            key = procedure.name
+        record = self.records.get(key)
+        if record is None:
+            record = self.records[key] = ProfileRecord(procedure)
+        record.calls += 1
+        record.active += 1
+        self.stack.append((record, time.perf_counter()))
+
+    def leave(self):
+        """End the last call started."""
+        record, start = self.stack.pop()
+        record.active -= 1
+        if not record.active:
+            record.time += time.perf_counter() - start
+
+    def depth(self):
+        """The number of calls in progress."""
+        return len(self.stack)
+
+    def unwind(self, depth):
+        """End calls until DEPTH are in progress."""
+        while len(self.stack) > depth:
+            self.leave()
+
+    def switch(self, procedure, depth):
+        """Start a call to PROCEDURE in place of the last call started, if
+        more than DEPTH are in progress, as for a tail call."""
+        if len(self.stack) > depth:
+            self.leave()
+        self.enter(procedure)
+
+    def trampoline(self, stack):
+        """Make the calls on the CallStack STACK as scheme_apply does, and
+        return the value of the last. A tree-walked lambda body pushes the
+        call in tail position onto STACK, so the call to a lambda procedure
+        that the trampoline makes lasts until the next one."""
+        depth, result = len(self.stack), None
+        try:
+            while stack:
+                procedure, args, env = stack.pop()
+                if (isinstance(procedure, LambdaProcedure) and
+                        procedure.execute is None and procedure.code is None):
+                    self.switch(procedure, depth)
+                try:
+                    result = procedure.apply(args, env, stack)
+                except AttributeError as err:
+                    raise SchemeError(err)
+            return result
+        finally:
+            self.unwind(depth)
+
+    def call(self, procedure, fn, *args):
+        """Return FN(*ARGS), profiled as a call to PROCEDURE."""
+        self.enter(procedure)
+        try:
+            return fn(*args)
+        finally:
+            self.leave()
+
+    def summary(self):
+        """The profile as a dict of lists and dicts, to be written as JSON."""
+        records = sorted(self.records.values(), key=lambda r: -r.time)
+        return {
+            'procedures': [{'name': r.name, 'kind': r.kind, 'calls': r.calls,
+                            'seconds': r.time} for r in records],
+            'special_forms': self.forms,
+            'frames': self.frames,
+        }
+
+    def report(self, file=sys.stdout):
+        """Print the profile to FILE, with the procedures that took the most
+        time first."""
+        summary = self.summary()
+        print('{0:>10} {1:>10} {2:>12}  {3}'.format(
+            'calls', 'seconds', 'usec/call', 'procedure'), file=file)
+        for r in summary['procedures']:
+            print('{0:>10} {1:>10.3f} {2:>12.2f}  {3}'.format(
+                r['calls'], r['seconds'], r['seconds'] * 1e6 / r['calls'],
+                r['name']), file=file)
+        for title, counts in (('special form', summary['special_forms']),
+                              ('frame', summary['frames'])):
+            print(file=file)
+            print('{0:>10}  {1}'.format('count', title), file=file)
+            for name, count in sorted(counts.items(), key=lambda item: -item[1]):
+                print('{0:>10}  {1}'.format(count, name), file=file)
 
 ####################
 # Extra Procedures #
@@ -504,59 +2650,446 @@ def complete_apply(procedure, args, env):
 def scheme_map(fn, s, env):
     validate_type(fn, scheme_procedurep, 0, 'map')
     validate_type(s, scheme_listp, 1, 'map')
-    return s.map(lambda x: complete_apply(fn, Pair(x, nil), env))
+    apply = value_applier(fn, env)
+    return Pair.from_iterable([apply([x]) for x in s.to_list()])
 
 def scheme_filter(fn, s, env):
     validate_type(fn, scheme_procedurep, 0, 'filter')
     validate_type(s, scheme_listp, 1, 'filter')
-    head, current = nil, nil
-    while s is not nil:
-        item, s = s.first, s.rest
-        if complete_apply(fn, Pair(item, nil), env):
-            if head is nil:
-                head = Pair(item, nil)
-                current = head
-            else:
-                current.rest = Pair(item, nil)
-                current = current.rest
-    return head
+    apply = value_applier(fn, env)
+    return Pair.from_iterable([item for item in s.to_list() if apply([item])])
 
 def scheme_reduce(fn, s, env):
     validate_type(fn, scheme_procedurep, 0, 'reduce')
     validate_type(s, lambda x: x is not nil, 1, 'reduce')
     validate_type(s, scheme_listp, 1, 'reduce')
-    value, s = s.first, s.rest
-    while s is not nil:
-        value = complete_apply(fn, scheme_list(value, s.first), env)
-        s = s.rest
+    apply, values = value_applier(fn, env), s.to_list()
+    value = values[0]
+    for item in values[1:]:
+        value = apply([value, item])
     return value
 
+def scheme_sort(s, less, env):
+    """Return a list of the items of the list S, stably sorted so that no item
+    is LESS than one before it. Sorting numbers by the builtin < or > does not
+    call it.
+
+    >>> env = create_global_frame()
+    >>> scheme_eval(read_line("(sort '(3 1 2) >)"), env)
+    Pair(3, Pair(2, Pair(1, nil)))
+    >>> print(scheme_eval(read_line("(sort '((b 1) (a 2) (b 0)) (lambda (x y) (< (car (cdr x)) (car (cdr y)))))"), env))
+    ((b 0) (b 1) (a 2))
+    """
+    validate_type(s, scheme_listp, 0, 'sort')
+    validate_type(less, scheme_procedurep, 1, 'sort')
+    values = s.to_list()
+    if (type(less) is BuiltinProcedure and less.fn in (scheme_lt, scheme_gt) and
+            all(scheme_numberp(value) for value in values)):
+        values.sort(reverse=less.fn is scheme_gt)
+    else:
+        apply = value_applier(less, env)
+        values.sort(key=lambda value: SortKey(value, apply))
+    return Pair.from_iterable(values)
+
+class SortKey(object):
+    """An item of a list being sorted, which is less than another if LESS,
+    a function of a Python list of two values, returns a true value."""
+    __slots__ = ('value', 'less')
+
+    def __init__(self, value, less):
+        self.value = value
+        self.less = less
+
+    def __lt__(self, other):
+        return self.less([self.value, other.value]) is not False
+
+###########################
+# Vectors and Hash Tables #
+###########################
+
+EXTRA_BUILTINS = []  # Entered into the global frame after BUILTINS
+
+def extra_builtin(*names):
+    """Register a function as a builtin named NAMES, as builtin does."""
+    def add(fn):
+        for name in names:
+            EXTRA_BUILTINS.append((name, fn, names[0]))
+        return fn
+    return add
+
+def validate_index(k, v, name):
+    """Return K as an index of the Vector V, or raise a SchemeError."""
+    validate_type(k, scheme_integerp, 1, name)
+    if not 0 <= k < len(v.items):
+        raise SchemeError('{0}: index {1} out of range'.format(name, k))
+    return int(k)
+
+@extra_builtin("vector?")
+def scheme_vectorp(x):
+    return isinstance(x, Vector)
+
+@extra_builtin("make-vector")
+def scheme_make_vector(k, fill=0):
+    validate_type(k, lambda x: scheme_integerp(x) and x >= 0, 0, 'make-vector')
+    return Vector([fill] * int(k))
+
+@extra_builtin("vector")
+def scheme_vector(*vals):
+    return Vector(list(vals))
+
+@extra_builtin("vector-length")
+def scheme_vector_length(v):
+    validate_type(v, scheme_vectorp, 0, 'vector-length')
+    return len(v.items)
+
+@extra_builtin("vector-ref")
+def scheme_vector_ref(v, k):
+    validate_type(v, scheme_vectorp, 0, 'vector-ref')
+    return v.items[validate_index(k, v, 'vector-ref')]
+
+@extra_builtin("vector-set!")
+def scheme_vector_set(v, k, val):
+    validate_type(v, scheme_vectorp, 0, 'vector-set!')
+    v.items[validate_index(k, v, 'vector-set!')] = val
+
+@extra_builtin("vector-fill!")
+def scheme_vector_fill(v, val):
+    validate_type(v, scheme_vectorp, 0, 'vector-fill!')
+    v.items[:] = [val] * len(v.items)
+
+@extra_builtin("vector->list")
+def scheme_vector_to_list(v):
+    validate_type(v, scheme_vectorp, 0, 'vector->list')
+    return Pair.from_iterable(v.items)
+
+@extra_builtin("list->vector")
+def scheme_list_to_vector(s):
+    validate_type(s, scheme_listp, 0, 'list->vector')
+    return Vector(s.to_list())
+
+@extra_builtin("assoc")
+def scheme_assoc(key, alist):
+    return find_association(key, alist, scheme_equalp, 'assoc')
+
+@extra_builtin("assq")
+def scheme_assq(key, alist):
+    return find_association(key, alist, scheme_eqp, 'assq')
+
+def find_association(key, alist, same, name):
+    """Return the first pair in the association list ALIST whose first is
+    the SAME as KEY, or False if there is none."""
+    validate_type(alist, scheme_listp, 1, name)
+    while alist is not nil:
+        pair = validate_type(alist.first, scheme_pairp, 1, name)
+        if same(key, pair.first):
+            return pair
+        alist = alist.rest
+    return False
+
+@extra_builtin("hash-table?")
+def scheme_hash_tablep(x):
+    return isinstance(x, HashTable)
+
+@extra_builtin("make-hash-table")
+def scheme_make_hash_table():
+    return HashTable()
+
+@extra_builtin("hash-ref")
+def scheme_hash_ref(table, key, *default):
+    validate_type(table, scheme_hash_tablep, 0, 'hash-ref')
+    if len(default) > 1:
+        raise SchemeError('hash-ref: too many arguments')
+    try:
+        return table[key]
+    except KeyError:
+        if default:
+            return default[0]
+        raise SchemeError('hash-ref: no value for key {0}'.format(repl_str(key)))
+
+@extra_builtin("hash-set!")
+def scheme_hash_set(table, key, val):
+    validate_type(table, scheme_hash_tablep, 0, 'hash-set!')
+    table[key] = val
+
+@extra_builtin("hash-has-key?")
+def scheme_hash_has_keyp(table, key):
+    validate_type(table, scheme_hash_tablep, 0, 'hash-has-key?')
+    return key in table
+
+@extra_builtin("hash-remove!")
+def scheme_hash_remove(table, key):
+    validate_type(table, scheme_hash_tablep, 0, 'hash-remove!')
+    if key in table:
+        del table[key]
+
+@extra_builtin("hash-count")
+def scheme_hash_count(table):
+    validate_type(table, scheme_hash_tablep, 0, 'hash-count')
+    return len(table)
+
+@extra_builtin("hash-keys")
+def scheme_hash_keys(table):
+    validate_type(table, scheme_hash_tablep, 0, 'hash-keys')
+    return Pair.from_iterable([key for key, _ in table.items()])
+
+@extra_builtin("hash-values")
+def scheme_hash_values(table):
+    validate_type(table, scheme_hash_tablep, 0, 'hash-values')
+    return Pair.from_iterable([value for _, value in table.items()])
+
+###########
+# Strings #
+###########
+
+# Strings are Strings, views of Python strs, so substring copies nothing. The
+# reader has no syntax for characters, so a character is a String of length
+# one. These replace the builtins that took strings to be str tokens.
+
+@extra_builtin("string?")
+def scheme_stringp(x):
+    return isinstance(x, String)
+
+@extra_builtin("atom?")
+def scheme_atomp(x):
+    return (scheme_booleanp(x) or scheme_numberp(x) or scheme_symbolp(x) or
+            scheme_nullp(x) or scheme_stringp(x))
+
+@extra_builtin("display")
+def scheme_display(*vals):
+    vals = [val.value if scheme_stringp(val) else repl_str(val) for val in vals]
+    print(*vals, end="")
+
+@extra_builtin("displayln")
+def scheme_displayln(*vals):
+    scheme_display(*vals)
+    scheme_newline()
+
+@extra_builtin("string-length")
+def scheme_string_length(s):
+    validate_type(s, scheme_stringp, 0, 'string-length')
+    return len(s)
+
+@extra_builtin("substring")
+def scheme_substring(s, start, end=None):
+    validate_type(s, scheme_stringp, 0, 'substring')
+    if end is None:
+        end = len(s)
+    for k, index in ((1, start), (2, end)):
+        validate_type(index, scheme_integerp, k, 'substring')
+    if not 0 <= start <= end <= len(s):
+        raise SchemeError('substring: range {0} to {1} out of range'.format(start, end))
+    return s.substring(int(start), int(end))
+
+@extra_builtin("string-append")
+def scheme_string_append(*strings):
+    for k, s in enumerate(strings):
+        validate_type(s, scheme_stringp, k, 'string-append')
+    if len(strings) == 1:
+        return strings[0]
+    return String(''.join(s.value for s in strings))
+
+@extra_builtin("string->list")
+def scheme_string_to_list(s):
+    validate_type(s, scheme_stringp, 0, 'string->list')
+    return Pair.from_iterable([String(char) for char in s.value])
+
+###############
+# Memoization #
+###############
+
+MEMO_SIZE = 1024  # The number of values a memoized procedure keeps by default
+
+class MemoProcedure(BuiltinProcedure):
+    """A procedure that calls PROCEDURE and keeps the values of the last
+    MAXSIZE calls, by their arguments as compared by equal?. The value kept
+    longest since it was last used is forgotten first."""
+    __slots__ = ('procedure', 'maxsize', 'cache', 'hits', 'misses')
+
+    def __init__(self, procedure, maxsize=MEMO_SIZE, name='memoized'):
+        BuiltinProcedure.__init__(self, None, True, name)
+        self.procedure = procedure
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.hits = self.misses = 0
+
+    def call(self, lst, env):
+        key = tuple(hash_key(value) for value in lst)
+        cache = self.cache
+        if key in cache:
+            self.hits += 1
+            cache.move_to_end(key)
+            return cache[key]
+        self.misses += 1
+        value = value_applier(self.procedure, env)(lst)
+        cache[key] = value
+        if len(cache) > self.maxsize:
+            cache.popitem(last=False)
+        return value
+
+@extra_builtin("memoize")
+def scheme_memoize(procedure, maxsize=MEMO_SIZE):
+    validate_type(procedure, scheme_procedurep, 0, 'memoize')
+    validate_type(maxsize, lambda x: scheme_integerp(x) and x > 0, 1, 'memoize')
+    name = getattr(procedure, 'name', None)
+    return MemoProcedure(procedure, int(maxsize), str(name or 'memoized'))
+
+MEMOIZE = BuiltinProcedure(scheme_memoize, name='memoize')  # For define-memo
+
+@extra_builtin("memo-stats")
+def scheme_memo_stats(procedure):
+    """Return a list of the hits, misses, size and maximum size of the cache of
+    a memoized PROCEDURE."""
+    validate_type(procedure, lambda x: isinstance(x, MemoProcedure), 0, 'memo-stats')
+    return scheme_list(procedure.hits, procedure.misses, len(procedure.cache),
+                       procedure.maxsize)
+
+@extra_builtin("memo-clear!")
+def scheme_memo_clear(procedure):
+    validate_type(procedure, lambda x: isinstance(x, MemoProcedure), 0, 'memo-clear!')
+    procedure.cache.clear()
+    procedure.hits = procedure.misses = 0
+
+###########
+# Streams #
+###########
+
+# A stream is a Pair whose rest is a Promise of the rest of the stream, or
+# nil. The stream procedures also accept a Scheme list as a stream that has
+# already been forced. They loop rather than recur over the elements of a
+# stream, so a long stream takes no more Python stack than a short one.
+
+class Promise(object):
+    """A value that is computed by calling THUNK, a Python function of no
+    arguments, when it is first forced, and kept after that.
+
+    >>> env = create_global_frame()
+    >>> _ = scheme_eval(read_line("(define p (delay (begin (display 'once) 1)))"), env)
+    >>> scheme_eval(read_line('(+ (force p) (force p))'), env)
+    once2
+    """
+    __slots__ = ('thunk', 'value')
+
+    def __init__(self, thunk):
+        self.thunk = thunk
+        self.value = None
+
+    def evaluate(self):
+        """Return the value of SELF, calling THUNK if it is not yet forced."""
+        thunk = self.thunk
+        if thunk is not None:
+            value = thunk()
+            if self.thunk is not None:  # Unless forced again by THUNK itself
+                self.value, self.thunk = value, None  # Let THUNK be collected
+        return self.value
+
+    def __str__(self):
+        return '#[promise ({0}forced)]'.format(
+            'not ' if self.thunk is not None else '')
+
+def make_promise(procedure, env):
+    """Return a Promise of the value of calling PROCEDURE with no arguments."""
+    apply = value_applier(procedure, env)
+    return Promise(lambda: apply([]))
+
+MAKE_PROMISE = BuiltinProcedure(make_promise, True, 'delay')  # For delay
+CONS = BuiltinProcedure(scheme_cons, name='cons')  # For cons-stream
+
+def scheme_streamp(x):
+    return x is nil or isinstance(x, Pair)
+
+def stream_rest(s, name):
+    """Return the rest of the non-empty stream S, forcing it if need be."""
+    rest = s.rest
+    if isinstance(rest, Promise):
+        rest = rest.evaluate()
+    if not scheme_streamp(rest):
+        raise SchemeError('{0}: the rest of a stream must be a stream, not {1}'.format(
+            name, repl_str(rest)))
+    return rest
+
+def scheme_stream_map(fn, s, env):
+    validate_type(fn, scheme_procedurep, 0, 'stream-map')
+    validate_type(s, scheme_streamp, 1, 'stream-map')
+    apply = value_applier(fn, env)
+    def map_stream(s):
+        if s is nil:
+            return nil
+        return Pair(apply([s.first]),
+                    Promise(lambda: map_stream(stream_rest(s, 'stream-map'))))
+    return map_stream(s)
+
+def scheme_stream_filter(fn, s, env):
+    validate_type(fn, scheme_procedurep, 0, 'stream-filter')
+    validate_type(s, scheme_streamp, 1, 'stream-filter')
+    apply = value_applier(fn, env)
+    def filter_stream(s):
+        while s is not nil and is_false_primitive(apply([s.first])):
+            s = stream_rest(s, 'stream-filter')
+        if s is nil:
+            return nil
+        return Pair(s.first,
+                    Promise(lambda: filter_stream(stream_rest(s, 'stream-filter'))))
+    return filter_stream(s)
+
+@extra_builtin("stream-take")
+def scheme_stream_take(s, k):
+    """Return a list of the first K elements of the stream S, or all of them
+    if it has fewer. Nothing after the Kth element is forced.
+
+    Streams may be infinite, and stream-filter can skip any number of
+    elements without recursion.
+
+    >>> for evaluate in (scheme_eval, analyze_eval, vm_eval):
+    ...     env = create_global_frame()
+    ...     _ = evaluate(read_line('(define (ints n) (cons-stream n (ints (+ n 1))))'), env)
+    ...     print(*(repl_str(evaluate(read_line(line), env)) for line in [
+    ...         '(stream-take (ints 1) 3)',
+    ...         '(stream-take (stream-map (lambda (x) (* x x)) (ints 1)) 3)',
+    ...         '(stream-take (stream-filter (lambda (x) (= (modulo x 5000) 0)) (ints 1)) 2)']))
+    (1 2 3) (1 4 9) (5000 10000)
+    (1 2 3) (1 4 9) (5000 10000)
+    (1 2 3) (1 4 9) (5000 10000)
+    """
+    validate_type(s, scheme_streamp, 0, 'stream-take')
+    validate_type(k, lambda x: scheme_integerp(x) and x >= 0, 1, 'stream-take')
+    items = []
+    while s is not nil and len(items) < k:
+        items.append(s.first)
+        if len(items) < k:
+            s = stream_rest(s, 'stream-take')
+    return Pair.from_iterable(items)
+
 ################
 # Input/Output #
 ################
 
 def read_eval_print_loop(next_line, env, interactive=False, quiet=False,
-                         startup=False, load_files=()):
-    """Read and evaluate input until an end of file or keyboard interrupt."""
+                         startup=False, load_files=(), evaluate=scheme_eval,
+                         read=scheme_read, parallel=0, fold=False):
+    """Read and evaluate input until an end of file or keyboard interrupt.
+    Each expression is read by READ from what NEXT_LINE returns, and evaluated
+    by EVALUATE, a function of an expression and an environment. If PARALLEL
+    is more than 1, expressions are evaluated by parallel_eval_loop with that
+    many worker processes. If FOLD is true, each expression is folded by a
+    Folder before it is evaluated."""
     if startup:
         for filename in load_files:
             scheme_load(filename, True, env)
+    if fold:
+        read = Folder(env).reader(read)
+    if parallel > 1:
+        return parallel_eval_loop(next_line, env, quiet, evaluate, read,
+                                  parallel)
     while True:
         try:
             src = next_line()
             while src.more_on_line:
-                expression = scheme_read(src)
-                result = scheme_eval(expression, env)
+                expression = read(src)
+                result = evaluate(expression, env)
                 if not quiet and result is not None:
                     print(repl_str(result))
         except (SchemeError, SyntaxError, ValueError, RuntimeError) as err:
-            if (isinstance(err, RuntimeError) and
-                'maximum recursion depth exceeded' not in getattr(err, 'args')[0]):
-                raise
-            elif isinstance(err, RuntimeError):
-                print('Error: maximum recursion depth exceeded')
-            else:
-                print('Error:', err)
+            print_error(err)
         except KeyboardInterrupt:  # <Control>-C
             if not startup:
                 raise
@@ -568,10 +3101,57 @@ def read_eval_print_loop(next_line, env, interactive=False, quiet=False,
             print()
             return
 
-def scheme_load(*args):
+def print_error(err):
+    """Print ERR, an error caught by read_eval_print_loop, or re-raise it if
+    it is a RuntimeError other than a recursion error."""
+    if (isinstance(err, RuntimeError) and
+        'maximum recursion depth exceeded' not in getattr(err, 'args')[0]):
+        raise err
+    elif isinstance(err, RuntimeError):
+        print('Error: maximum recursion depth exceeded')
+    else:
+        print('Error:', err)
+
+EVALUATE = scheme_eval  # The evaluator that scheme_load evaluates files with
+
+def scheme_load(*args, evaluate=None):
     """Load a Scheme source file. ARGS should be of the form (SYM, ENV) or
     (SYM, QUIET, ENV). The file named SYM is loaded into environment ENV,
-    with verbosity determined by QUIET (default true)."""
+    with verbosity determined by QUIET (default true). Its expressions are
+    evaluated by EVALUATE, or by the evaluator in EVALUATE if it is None.
+
+    A procedure loaded by the VM recurses as deeply as one typed at it:
+
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile('w', suffix='.scm', delete=False) as f:
+    ...     _ = f.write('(define (count n) (if (= n 0) 0 (+ 1 (count (- n 1)))))')
+    >>> env = create_global_frame()
+    >>> scheme_load(f.name, env, evaluate=vm_eval)
+    <BLANKLINE>
+    >>> vm_eval(read_line('(count 5000)'), env)
+    5000
+    >>> for path in (f.name, f.name + 'c'):
+    ...     if os.path.exists(path):
+    ...         os.unlink(path)
+
+    A file too large to cache is streamed through the reader, so it is never
+    all in memory at once:
+
+    >>> import tracemalloc
+    >>> with tempfile.NamedTemporaryFile('w', suffix='.scm', delete=False) as f:
+    ...     for i in range(2000):
+    ...         _ = f.write('(define x {0}) ; {1}\\n'.format(i, 'x' * 1000))
+    >>> os.path.getsize(f.name) > CACHE_MAX_SIZE
+    True
+    >>> tracemalloc.start()
+    >>> scheme_load(f.name, env)
+    <BLANKLINE>
+    >>> peak = tracemalloc.get_traced_memory()[1]
+    >>> tracemalloc.stop()
+    >>> peak < CACHE_MAX_SIZE // 8, env.lookup('x'), os.path.exists(f.name + 'c')
+    (True, 1999, False)
+    >>> os.unlink(f.name)
+    """
     if not (2 <= len(args) <= 3):
         expressions = args[:-1]
         raise SchemeError('"load" given incorrect number of arguments: '
@@ -580,15 +3160,144 @@ def scheme_load(*args):
     quiet = args[1] if len(args) > 2 else True
     env = args[-1]
     if (scheme_stringp(sym)):
-        sym = eval(sym)
+        sym = sym.value
     validate_type(sym, scheme_symbolp, 0, 'load')
+    prompt = None if quiet else 'scm> '
+    parallel = PARALLEL if env.is_global else 0
+    fold = FOLD and env.is_global
+    evaluate = evaluate or EVALUATE
     with scheme_open(sym) as infile:
-        lines = infile.readlines()
-    args = (lines, None) if quiet else (lines,)
-    def next_line():
-        return buffer_lines(*args)
+        groups = read_cached(infile) if quiet else None
+        if groups is not None:
+            groups = iter(groups)
+            def next_line():
+                for group in groups:
+                    return ExpressionBuffer(group)
+                raise EOFError
+
+            read_eval_print_loop(next_line, env, quiet=quiet,
+                                 evaluate=evaluate,
+                                 read=ExpressionBuffer.pop_first,
+                                 parallel=parallel, fold=fold)
+            return
 
-    read_eval_print_loop(next_line, env, quiet=quiet)
+        def next_line():
+            return buffer_file(infile, prompt)
+
+        read_eval_print_loop(next_line, env, quiet=quiet, evaluate=evaluate,
+                             parallel=parallel, fold=fold)
+
+# Parsed files are cached in a pickle next to the source, named with the
+# extension .scmc. A cache is used if the source's modification time or the
+# hash of its contents matches the one it was made from. Larger files are
+# streamed through the reader instead. A cache is loaded by a CacheUnpickler,
+# since anyone who can write next to a source file can write its cache.
+CACHE_VERSION = 4
+CACHE_MAX_SIZE = 1 << 20
+
+class CacheUnpickler(pickle.Unpickler):
+    """An Unpickler that can only make the values that the reader returns, so
+    that loading a cache cannot call anything else.
+
+    >>> import io
+    >>> expr = read_line('(define (f x) "one" (g (quote x) 2.5 #t))')
+    >>> CacheUnpickler(io.BytesIO(pickle.dumps(expr))).load() == expr
+    True
+    >>> try:
+    ...     CacheUnpickler(io.BytesIO(pickle.dumps(os.getcwd))).load()
+    ... except pickle.UnpicklingError as exc:
+    ...     print(exc)
+    cannot load posix.getcwd from a cache
+    """
+    names = {('scheme_reader', 'Pair'): Pair,
+             ('scheme_reader', 'nil'): nil,
+             ('scheme_reader', 'String'): String,
+             ('scheme_reader', 'intern'): intern}
+
+    def find_class(self, module, name):
+        if (module, name) == ('builtins', 'getattr'):
+            return self.getattr  # Pair.from_iterable is pickled with getattr
+        if (module, name) not in self.names:
+            raise pickle.UnpicklingError(
+                'cannot load {0}.{1} from a cache'.format(module, name))
+        return self.names[module, name]
+
+    @staticmethod
+    def getattr(obj, name):
+        if obj is not Pair or name != 'from_iterable':
+            raise pickle.UnpicklingError('cannot load an attribute of '
+                                         '{0} from a cache'.format(obj))
+        return Pair.from_iterable
+
+class ExpressionBuffer(object):
+    """Expressions that have already been read, which read_eval_print_loop
+    can take in place of a Buffer of tokens."""
+
+    def __init__(self, expressions):
+        self.expressions = expressions
+        self.index = 0
+
+    @property
+    def more_on_line(self):
+        return self.index < len(self.expressions)
+
+    def pop_first(self):
+        self.index += 1
+        return self.expressions[self.index - 1]
+
+def read_cached(infile):
+    """Return the expressions in the open file INFILE, from its cache if it
+    is valid, as a list of groups: the expressions that read_eval_print_loop
+    would read from each Buffer. Return None, leaving INFILE at its start,
+    if the file is too large to cache or cannot be read without error."""
+    path = infile.name
+    base, extension = os.path.splitext(path)
+    cache_path = (base if extension == '.scm' else path) + '.scmc'
+    stat = os.fstat(infile.fileno())
+    if stat.st_size > CACHE_MAX_SIZE:
+        return None
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            cache = CacheUnpickler(cache_file).load()
+        if cache['version'] != CACHE_VERSION:
+            cache = None
+    except Exception:
+        cache = None
+    if cache is not None and cache['mtime'] == stat.st_mtime_ns:
+        return cache['groups']
+
+    text = infile.read()
+    digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    if cache is not None and cache['hash'] == digest:
+        groups = cache['groups']
+    else:
+        try:
+            groups = read_groups(text.splitlines())
+        except (SyntaxError, ValueError):
+            infile.seek(0)
+            return None
+    cache = {'version': CACHE_VERSION, 'mtime': stat.st_mtime_ns,
+             'hash': digest, 'groups': groups}
+    try:
+        with open(cache_path, 'wb') as cache_file:
+            pickle.dump(cache, cache_file)
+    except OSError:
+        pass
+    return groups
+
+def read_groups(lines):
+    """Read all the expressions in LINES, grouped by the Buffer they are read
+    from, as read_eval_print_loop would read them."""
+    groups, lines = [], iter(lines)
+    while True:
+        try:
+            src = buffer_file(lines, None)
+        except EOFError:
+            return groups
+        group = []
+        while src.more_on_line:
+            group.append(scheme_read(src))
+        groups.append(group)
 
 def scheme_open(filename):
     """If either FILENAME or FILENAME.scm is the name of a valid file,
@@ -604,7 +3313,19 @@ def scheme_open(filename):
         raise SchemeError(str(exc))
 
 def create_global_frame():
-    """Initialize and return a single-frame environment with built-in names."""
+    """Return a new global frame, whose parent is the shared BASE_FRAME of
+    built-in names.
+
+    >>> a, b = create_global_frame(), create_global_frame()
+    >>> scheme_eval(read_line('(define car cdr)'), a)
+    'car'
+    >>> a.lookup('car') is b.lookup('cdr'), b.lookup('car') is b.lookup('cdr')
+    (True, False)
+    """
+    return Frame(BASE_FRAME)
+
+def create_base_frame():
+    """Initialize and return a BaseFrame with built-in names."""
     env = Frame(None)
     env.define('eval',
                BuiltinProcedure(scheme_eval, True, 'eval'))
@@ -620,9 +3341,263 @@ def create_global_frame():
                BuiltinProcedure(scheme_filter, True, 'filter'))
     env.define('reduce',
                BuiltinProcedure(scheme_reduce, True, 'reduce'))
+    env.define('sort',
+               BuiltinProcedure(scheme_sort, True, 'sort'))
+    env.define('stream-map',
+               BuiltinProcedure(scheme_stream_map, True, 'stream-map'))
+    env.define('stream-filter',
+               BuiltinProcedure(scheme_stream_filter, True, 'stream-filter'))
     env.define('undefined', None)
     add_builtins(env, BUILTINS)
-    return env
+    add_builtins(env, EXTRA_BUILTINS)
+    return BaseFrame({intern(name): value for name, value in env.bindings.items()})
+
+BASE_FRAME = create_base_frame()
+
+#######################
+# Parallel Evaluation #
+#######################
+
+# parallel_eval_loop hands the top-level expressions of a file that cannot
+# change the global frame to a pool of worker processes, which evaluate them
+# in a copy of it. The expressions in each group read from a line (or from the
+# lines of a multi-line expression) are evaluated together, so that an error
+# skips the rest of the group, as in read_eval_print_loop.
+#
+# A group that mentions an impure name is a barrier: it may define or mutate
+# something that later groups depend on. The groups before it are finished,
+# and then it is evaluated in the parent and added to a log, which each worker
+# replays into its global frame before evaluating groups after it. A defined
+# procedure is impure if its body mentions an impure name, and a macro is
+# always impure, since its expansion is evaluated in the frame it is used in.
+# Forcing a promise keeps its value in it, so the names that force are impure,
+# and so is a memoized procedure, since each call updates its cache.
+
+PARALLEL = 0  # Worker processes for scheme_load to use for the global frame
+
+IMPURE_NAMES = frozenset(['define', 'define-macro', 'define-memo', 'load',
+                          'exit', 'eval', 'set-car!', 'set-cdr!', 'vector-set!',
+                          'vector-fill!', 'hash-set!', 'hash-remove!',
+                          'force', 'cdr-stream', 'stream-map', 'stream-filter',
+                          'stream-take', 'memo-stats', 'memo-clear!'])
+
+BATCH_SIZE = 1024  # The most groups to read before waiting for workers
+
+def parallel_eval_loop(next_line, env, quiet, evaluate, read, workers):
+    """Read and evaluate input as read_eval_print_loop does, until an end of
+    file, with WORKERS processes. Output is printed in the order the input
+    was read.
+
+    >>> import io
+    >>> from contextlib import redirect_stdout
+    >>> def run(lines, parallel):
+    ...     lines, output = iter(lines), io.StringIO()
+    ...     with redirect_stdout(output):
+    ...         read_eval_print_loop(lambda: buffer_file(lines, None),
+    ...                              create_global_frame(), parallel=parallel)
+    ...     return output.getvalue()
+    >>> memo = ['(define-memo (f n) n)', '(f 1)', '(f 1)', '(f 2)',
+    ...         '(memo-stats f)']
+    >>> print(run(memo, 4), end='')
+    f
+    1
+    1
+    2
+    (1 2 2 1024)
+    <BLANKLINE>
+    >>> run(memo, 4) == run(memo, 0)
+    True
+    >>> program = ['(define x (list 1 2))', '(define fs (list set-car!))',
+    ...            '((car fs) x 9)', '(define y (car x))', '(display y)',
+    ...            '(define (square n) (* n n))', '(square y)', 'x']
+    >>> print(run(program, 4), end='')
+    x
+    fs
+    y
+    9square
+    81
+    (9 2)
+    <BLANKLINE>
+    >>> run(program, 4) == run(program, 0)
+    True
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    import io
+    from contextlib import redirect_stdout
+
+    log, impure, batch, mentions = [], set(IMPURE_NAMES), [], {}
+    with ProcessPoolExecutor(workers) as pool:
+        def flush():
+            size = max(1, len(batch) // (4 * workers))
+            chunks = [batch[i:i + size] for i in range(0, len(batch), size)]
+            futures = [pool.submit(parallel_worker, log, [group for _, group in chunk],
+                                   quiet, evaluate.__name__) for chunk in chunks]
+            for chunk, future in zip(chunks, futures):
+                for (echo, _), output in zip(chunk, future.result()):
+                    sys.stdout.write(echo + output)
+            del batch[:]
+
+        while True:
+            echo = io.StringIO()  # The input echoed as it is read
+            with redirect_stdout(echo):
+                try:
+                    group = read_group(next_line(), read)
+                except EOFError:
+                    group = None
+                except (SyntaxError, ValueError) as err:
+                    group = ([], err)
+            if group is not None and not impure.intersection(
+                    mentioned_names(group[0])):
+                batch.append((echo.getvalue(), group))
+                if len(batch) >= BATCH_SIZE:
+                    flush()
+                continue
+            flush()
+            sys.stdout.write(echo.getvalue())
+            if group is None:
+                print()
+                return
+            try:
+                eval_group(group[0], group[1], env, quiet, evaluate)
+            except EOFError:
+                print()
+                return
+            log.append(group[0])
+            update_impure(impure, env, mentions)
+
+def read_group(src, read):
+    """Read the expressions in SRC with READ, as read_eval_print_loop does.
+    Return a list of them and the error that stopped reading, if any."""
+    expressions = []
+    try:
+        while src.more_on_line:
+            expressions.append(read(src))
+    except (SyntaxError, ValueError) as err:
+        return expressions, err
+    return expressions, None
+
+def eval_group(expressions, error, env, quiet, evaluate):
+    """Evaluate EXPRESSIONS in ENV, and then raise ERROR unless it is None,
+    printing results and errors as read_eval_print_loop does."""
+    try:
+        for expression in expressions:
+            result = evaluate(expression, env)
+            if not quiet and result is not None:
+                print(repl_str(result))
+        if error is not None:
+            raise error
+    except (SchemeError, SyntaxError, ValueError, RuntimeError) as err:
+        print_error(err)
+
+def mentioned_names(exprs):
+    """Return the set of the symbols that appear anywhere in EXPRS, a Python
+    list of Scheme expressions."""
+    names, pending = set(), list(exprs)
+    while pending:
+        expr = pending.pop()
+        while isinstance(expr, Pair):
+            pending.append(expr.first)
+            expr = expr.rest
+        if isinstance(expr, str):
+            names.add(expr)
+    return names
+
+def update_impure(impure, env, mentions):
+    """Add to the set IMPURE the names in the bindings of ENV whose values are
+    impure. Every binding is checked again, since a procedure defined earlier
+    may call a name that has only now been found to be impure, and a list
+    that a barrier changed may now hold an impure procedure. MENTIONS keeps
+    the names that each lambda body mentions, by its id.
+
+    >>> env, impure = create_global_frame(), set(IMPURE_NAMES)
+    >>> for line in ['(define fs (list car set-car!))', '(define gs (list car))',
+    ...              '(define (poke p) ((car (cdr fs)) p 1))']:
+    ...     _ = scheme_eval(read_line(line), env)
+    >>> update_impure(impure, env, {})
+    >>> sorted(name for name in impure if name in env.bindings)
+    ['fs', 'poke']
+    """
+    references = {}
+    for name, value in env.bindings.items():
+        if name not in impure:
+            references[name] = referenced_names(value, env, mentions)
+    while True:
+        added = [name for name, names in references.items()
+                 if names is None or not impure.isdisjoint(names)]
+        if not added:
+            return
+        for name in added:
+            impure.add(name)
+            del references[name]
+
+def referenced_names(value, env, mentions):
+    """Return the set of names that a call to VALUE, or to a procedure that
+    can be reached from it, may call by name; or None if such a call is
+    impure whatever they are bound to. Procedures are reached through pairs,
+    vectors, hash tables and the frames of closures, up to the global frame
+    ENV."""
+    names, pending, seen = set(), [value], set()
+    while pending:
+        value = pending.pop()
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        if isinstance(value, (MacroProcedure, MemoProcedure)):
+            return None
+        elif isinstance(value, BuiltinProcedure):
+            names.add(value.name)
+        elif isinstance(value, LambdaProcedure):
+            body = value.body
+            known, mentioned = mentions.get(id(body), (None, None))
+            if known is not body:
+                mentioned = mentioned_names([value.formals, body])
+                mentions[id(body)] = (body, mentioned)
+            names.update(mentioned)
+            frame = getattr(value, 'env', None)  # A MuProcedure has none
+            while frame is not None and frame is not env:
+                if frame.bindings is not None:
+                    pending.extend(frame.bindings.values())
+                if isinstance(frame, ArrayFrame):
+                    pending.extend(frame.values)
+                frame = frame.parent
+        elif isinstance(value, Pair):
+            pending.append(value.first)
+            pending.append(value.rest)
+        elif isinstance(value, Vector):
+            pending.extend(value.items)
+        elif isinstance(value, HashTable):
+            for entry in value.table.values():
+                pending.extend(entry)
+    return names
+
+WORKER_STATE = None  # A worker's global frame and the length of log it has run
+
+def parallel_worker(log, groups, quiet, engine):
+    """Evaluate each group of expressions in GROUPS in a global frame made by
+    evaluating the groups in LOG, and return the output of each."""
+    global WORKER_STATE, PARALLEL, EVALUATE
+    import io
+    from contextlib import redirect_stdout
+
+    evaluate = globals()[engine]
+    if WORKER_STATE is None:
+        PARALLEL, EVALUATE = 0, evaluate
+        WORKER_STATE = (create_global_frame(), 0)
+    env, done = WORKER_STATE
+    with redirect_stdout(io.StringIO()):
+        for expressions in log[done:]:
+            try:
+                eval_group(expressions, None, env, True, evaluate)
+            except EOFError:
+                pass
+    WORKER_STATE = (env, len(log))
+    outputs = []
+    for expressions, error in groups:
+        output = io.StringIO()
+        with redirect_stdout(output):
+            eval_group(expressions, error, env, quiet, evaluate)
+        outputs.append(output.getvalue())
+    return outputs
 
 @main
 def run(*argv):
@@ -634,10 +3609,26 @@ def run(*argv):
                         help='save the image to this location when done')
     parser.add_argument('-load', '-i', action='store_true',
                        help='run file interactively')
+    parser.add_argument('--analyze', action='store_true',
+                        help='analyze each expression into Python closures before evaluating it')
+    parser.add_argument('--vm', action='store_true',
+                        help='compile each expression to bytecode and run it on a virtual machine')
+    parser.add_argument('--profile', action='store_true',
+                        help='count and time procedure calls, and print a report at exit')
+    parser.add_argument('--profile-json', metavar='PATH', default=None,
+                        help='profile as with --profile, but write the report to PATH as JSON')
+    parser.add_argument('--parallel', metavar='N', type=int, default=0,
+                        help='evaluate the independent top-level expressions of files with N processes')
+    parser.add_argument('--max-depth', metavar='N', type=int, default=0,
+                        help='with --vm, make more than N calls in progress an error (default: no limit)')
+    parser.add_argument('--fold', action='store_true',
+                        help='fold constant expressions before evaluating them, reporting each rewrite')
     parser.add_argument('file', nargs='?',
                         type=argparse.FileType('r'), default=None,
                         help='Scheme file to run')
     args = parser.parse_args()
+    if args.max_depth and not args.vm:
+        parser.error('--max-depth requires --vm')
 
     import scheme
     scheme.TK_TURTLE = not args.pillow_turtle
@@ -647,17 +3638,43 @@ def run(*argv):
 
     next_line = buffer_input
     interactive = True
+    if args.vm:
+        evaluate = vm_eval
+    elif args.analyze:
+        evaluate = analyze_eval
+    else:
+        evaluate = scheme_eval
     load_files = []
 
     if args.file is not None:
         if args.load:
             load_files.append(getattr(args.file, 'name'))
         else:
-            lines = args.file.readlines()
             def next_line():
-                return buffer_lines(lines)
+                return buffer_file(args.file)
             interactive = False
 
-    read_eval_print_loop(next_line, create_global_frame(), startup=True,
-                         interactive=interactive, load_files=load_files)
+    global PARALLEL, FOLD, MAX_DEPTH, EVALUATE
+    EVALUATE = evaluate
+    PARALLEL = args.parallel
+    FOLD = args.fold
+    MAX_DEPTH = max(args.max_depth, 0)
+    profile = None
+    if args.profile or args.profile_json:
+        profile = Profile().install()
+    try:
+        read_eval_print_loop(next_line, create_global_frame(), startup=True,
+                             interactive=interactive, load_files=load_files,
+                             evaluate=evaluate,
+                             parallel=0 if interactive else args.parallel,
+                             fold=args.fold)
+    finally:
+        if profile is not None:
+            profile.uninstall()
+            if args.profile_json:
+                import json
+                with open(args.profile_json, 'w') as outfile:
+                    json.dump(profile.summary(), outfile, indent=2)
+            else:
+                profile.report(sys.stderr)
     tscheme_exitonclick()
\ No newline at end of file
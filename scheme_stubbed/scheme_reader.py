@@ -4,7 +4,8 @@ with a parser for Scheme expressions.
 In addition to the types defined in this file, some data types in Scheme are
 represented by their corresponding type in Python:
     number:       int or float
-    symbol:       string
+    symbol:       Symbol, a subclass of str
+    string:       String, a view of a str
     boolean:      bool
     unspecified:  None
 
@@ -18,6 +19,7 @@ would be read to the value, where possible.
 from __future__ import print_function  # Python 2 compatibility
 
 import numbers
+import weakref
 
 from ucb import main, trace, interact
 from scheme_tokens import tokenize_lines, DELIMITERS
@@ -36,15 +38,63 @@ class Pair(object):
     >>> print(s.map(lambda x: x+4))
     (5 6)
     """
+    __slots__ = ('first', 'rest')
+
     def __init__(self, first, rest):
-        from scheme_builtins import scheme_valid_cdrp, SchemeError
-        if not scheme_valid_cdrp(rest):
-            raise SchemeError("cdr can only be a pair, nil, or a promise but was {}".format(rest))
+        if rest is not nil and not isinstance(rest, Pair):
+            validate_cdr(rest)
         self.first = first
         self.rest = rest
 
+    @classmethod
+    def from_iterable(cls, values):
+        """Return a Scheme list of the elements of the Python iterable VALUES.
+
+        >>> Pair.from_iterable(range(3))
+        Pair(0, Pair(1, Pair(2, nil)))
+        >>> Pair.from_iterable([])
+        nil
+        """
+        if not isinstance(values, (list, tuple, range)):
+            values = list(values)
+        result = nil
+        for value in reversed(values):
+            result = cls(value, result)
+        return result
+
+    def to_list(self):
+        """Return the elements of SELF, a proper Scheme list, as a Python list.
+
+        >>> Pair(1, Pair(2, nil)).to_list()
+        [1, 2]
+        """
+        values, rest = [self.first], self.rest
+        while isinstance(rest, Pair):
+            values.append(rest.first)
+            rest = rest.rest
+        if rest is not nil:
+            raise TypeError('ill-formed list (cdr is a promise)')
+        return values
+
+    def __reduce__(self):
+        # Pickle a list as the Python list of its elements, since pickling
+        # each Pair as the state of the previous one would recurse once per
+        # element.
+        values, rest = [self.first], self.rest
+        while isinstance(rest, Pair):
+            values.append(rest.first)
+            rest = rest.rest
+        if rest is not nil:
+            return (Pair, (self.first, self.rest))
+        return (Pair.from_iterable, (values,))
+
     def __repr__(self):
-        return 'Pair({0}, {1})'.format(repr(self.first), repr(self.rest))
+        s, closing, rest = 'Pair(' + repr(self.first), ')', self.rest
+        while isinstance(rest, Pair):
+            s += ', Pair(' + repr(rest.first)
+            closing += ')'
+            rest = rest.rest
+        return s + ', ' + repr(rest) + closing
 
     def __str__(self):
         s = '(' + repl_str(self.first)
@@ -66,22 +116,41 @@ class Pair(object):
         return n
 
     def __eq__(self, p):
-        if not isinstance(p, Pair):
+        s = self
+        while isinstance(s, Pair) and isinstance(p, Pair):
+            if s is p:
+                return True
+            if not s.first == p.first:
+                return False
+            s, p = s.rest, p.rest
+        if isinstance(s, Pair) or isinstance(p, Pair):
             return False
-        return self.first == p.first and self.rest == p.rest
+        return s == p
 
     def map(self, fn):
         """Return a Scheme list after mapping Python function FN to SELF."""
-        mapped = fn(self.first)
-        if self.rest is nil or isinstance(self.rest, Pair):
-            return Pair(mapped, self.rest.map(fn))
-        else:
+        mapped, rest = [fn(self.first)], self.rest
+        while isinstance(rest, Pair):
+            mapped.append(fn(rest.first))
+            rest = rest.rest
+        if rest is not nil:
             raise TypeError('ill-formed list (cdr is a promise)')
-    
+        return Pair.from_iterable(mapped)
+
     def __contains__(self, sth):
-        if self == nil:
-            return False
-        return self.first == sth or sth in self.rest
+        s = self
+        while isinstance(s, Pair):
+            if s.first == sth:
+                return True
+            s = s.rest
+        return False
+
+def validate_cdr(rest):
+    """Raise a SchemeError unless REST may be the rest of a Pair. Pair and nil
+    are accepted by Pair.__init__ without calling this."""
+    from scheme_builtins import scheme_valid_cdrp, SchemeError
+    if not scheme_valid_cdrp(rest):
+        raise SchemeError("cdr can only be a pair, nil, or a promise but was {}".format(rest))
 
 class nil(object):
     """The empty list"""
@@ -98,14 +167,250 @@ class nil(object):
     def map(self, fn):
         return self
 
+    def to_list(self):
+        return []
+
+    def __reduce__(self):
+        return 'nil'  # Unpickle as the one instance
+
 nil = nil() # Assignment hides the nil class; there is only one instance
 
+# Vectors and hash tables
+
+class Vector(object):
+    """A fixed-length sequence of Scheme values, indexed in constant time.
+
+    >>> v = Vector([1, Pair(2, nil), True])
+    >>> v
+    Vector([1, Pair(2, nil), True])
+    >>> print(v)
+    #(1 (2) #t)
+    """
+    __slots__ = ('items',)
+
+    def __init__(self, items):
+        self.items = items
+
+    def __repr__(self):
+        return 'Vector({0})'.format(repr(self.items))
+
+    def __str__(self):
+        return '#(' + ' '.join(repl_str(item) for item in self.items) + ')'
+
+    def __len__(self):
+        return len(self.items)
+
+    def __eq__(self, other):
+        return isinstance(other, Vector) and self.items == other.items
+
+    __hash__ = None
+
+class HashTable(object):
+    """A mutable mapping from Scheme values to Scheme values. Keys are
+    compared as by equal?, so a list or vector that is mutated after it is
+    used as a key is not found by its new contents.
+
+    >>> t = HashTable()
+    >>> t[Pair(1, nil)] = 'a'
+    >>> t[1.0] = 'b'
+    >>> t[Pair(1, nil)], t[1], len(t)
+    ('a', 'b', 2)
+    >>> print(t)
+    #hash(((1) . a) (1.0 . b))
+    """
+    __slots__ = ('table',)
+
+    def __init__(self):
+        self.table = {}  # hash_key(key) -> [key, value]
+
+    def __getitem__(self, key):
+        return self.table[hash_key(key)][1]
+
+    def __setitem__(self, key, value):
+        k = hash_key(key)
+        entry = self.table.get(k)
+        if entry is None:
+            self.table[k] = [key, value]
+        else:
+            entry[1] = value
+
+    def __delitem__(self, key):
+        del self.table[hash_key(key)]
+
+    def __contains__(self, key):
+        return hash_key(key) in self.table
+
+    def __len__(self):
+        return len(self.table)
+
+    def items(self):
+        """The (key, value) pairs of SELF, in the order they were added."""
+        return [(key, value) for key, value in self.table.values()]
+
+    def __repr__(self):
+        return '<HashTable of {0} entries>'.format(len(self))
+
+    def __str__(self):
+        return '#hash(' + ' '.join('({0} . {1})'.format(repl_str(key), repl_str(value))
+                                   for key, value in self.items()) + ')'
+
+def hash_key(value):
+    """Return a hashable Python value for the Scheme value VALUE, such that
+    values that are equal? have equal keys and others do not.
+
+    >>> hash_key(Pair(1, Pair(Vector([2]), nil))) == hash_key(read_line('(1.0 2)'))
+    False
+    >>> hash_key(Pair(1, nil)) == hash_key(Pair(1.0, nil))
+    True
+    >>> hash_key(True) == hash_key(1)
+    False
+    """
+    if isinstance(value, bool):
+        return (bool, value)  # True == 1 in Python, but not in Scheme
+    elif isinstance(value, Pair):
+        items = []
+        while isinstance(value, Pair):
+            items.append(hash_key(value.first))
+            value = value.rest
+        return (Pair, tuple(items), hash_key(value))
+    elif isinstance(value, Vector):
+        return (Vector, tuple(hash_key(item) for item in value.items))
+    elif isinstance(value, String):
+        return (String, value.value)  # Not the view, which keeps its text
+    return value
+
+# Strings
+
+class String(object):
+    """A Scheme string: the characters of the Python str TEXT from START to
+    END. A substring is another String of the same TEXT, so taking one copies
+    nothing, and its length is known without counting.
+
+    >>> s = String('one two three')
+    >>> t = s.substring(4, 13).substring(0, 3)
+    >>> t, len(t), t.text is s.text
+    (String('two'), 3, True)
+    >>> print(String('say "hi"\\n'))
+    "say \\"hi\\"\\n"
+    >>> t == String('two') and hash(t) == hash(String('two'))
+    True
+    """
+    __slots__ = ('text', 'start', 'end')
+
+    def __init__(self, text, start=0, end=None):
+        self.text = text
+        self.start = start
+        self.end = len(text) if end is None else end
+
+    @property
+    def value(self):
+        """The characters of SELF as a Python str."""
+        if self.start == 0 and self.end == len(self.text):
+            return self.text
+        return self.text[self.start:self.end]
+
+    def substring(self, start, end):
+        """The String of the characters of SELF from START to END."""
+        return String(self.text, self.start + start, self.start + end)
+
+    def __repr__(self):
+        return 'String({0})'.format(repr(self.value))
+
+    def __str__(self):
+        value = self.value
+        for char, escape in STRING_ESCAPES:
+            if char in value:
+                value = value.replace(char, escape)
+        return '"' + value + '"'
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __eq__(self, other):
+        return (isinstance(other, String) and len(self) == len(other) and
+                self.value == other.value)
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __reduce__(self):
+        return (String, (self.value,))  # Not the rest of the text
+
+# The characters written with a backslash in a string literal, backslash first
+STRING_ESCAPES = [('\\', '\\\\'), ('"', '\\"'), ('\n', '\\n'), ('\t', '\\t')]
+UNESCAPES = {escape: char for char, escape in STRING_ESCAPES}
+
+def read_string(token):
+    """Return the characters of TOKEN, a string literal in quotes, with its
+    escapes replaced. Only the escapes in STRING_ESCAPES are allowed.
+
+    >>> print(read_string(r'"say \\"hi\\"\\n\\\\"'))
+    say "hi"
+    \\
+    >>> read_string(r'"\\x41"')
+    Traceback (most recent call last):
+        ...
+    SyntaxError: unknown escape \\x in string
+    """
+    text = token[1:-1]
+    if '\\' not in text:
+        return text
+    chars, start = [], 0
+    index = text.find('\\')
+    while index >= 0:
+        escape = text[index:index + 2]
+        if escape not in UNESCAPES:
+            raise SyntaxError('unknown escape {0} in string'.format(escape))
+        chars.append(text[start:index])
+        chars.append(UNESCAPES[escape])
+        start = index + 2
+        index = text.find('\\', start)
+    chars.append(text[start:])
+    return ''.join(chars)
+
+# Symbols
+
+class Symbol(str):
+    """A Scheme symbol. There is only one Symbol of each name, made by intern,
+    so symbols that are equal are the same object, and a dict probe with one
+    finds a key that is the same symbol without comparing their characters.
+    SPECIAL is true of the names of special forms.
+
+    >>> intern('lambda') is read_line('lambda')
+    True
+    """
+    special = False
+
+    def __reduce__(self):
+        return (intern, (str(self),))  # Unpickle as the one instance
+
+# The Symbol of each name that has been interned. It holds them weakly, so
+# a symbol that nothing refers to any more is freed instead of being kept for
+# the life of the process.
+SYMBOLS = weakref.WeakValueDictionary()
+
+def intern(name):
+    """Return the Symbol named NAME, making it if there is none yet.
+
+    >>> symbol = intern('an-unusual-name')
+    >>> 'an-unusual-name' in SYMBOLS
+    True
+    >>> del symbol
+    >>> 'an-unusual-name' in SYMBOLS
+    False
+    """
+    symbol = SYMBOLS.get(name)
+    if symbol is None:
+        symbol = SYMBOLS[name] = Symbol(name)
+    return symbol
+
 # Scheme list parser
 
 # Quotation markers
-quotes = {"'":  'quote',
-          '`':  'quasiquote',
-          ',':  'unquote'}
+quotes = {"'":  intern('quote'),
+          '`':  intern('quasiquote'),
+          ',':  intern('unquote'),
+          ',@': intern('unquote-splicing')}
 
 def scheme_read(src):
     """Read the next expression from SRC, a Buffer of tokens.
@@ -138,8 +443,10 @@ def scheme_read(src):
             raise SyntaxError
     elif token == 'nil':
         return nil
+    elif token.startswith('"'):
+        return String(read_string(token))
     else:
-        return token
+        return intern(token)
     # END PROBLEM 1/2
 
 def read_tail(src):
@@ -151,15 +458,16 @@ def read_tail(src):
     Pair(2, Pair(3, nil))
     """
     try:
-        if src.current() is None:
-            raise SyntaxError('unexpected end of file')
         # BEGIN PROBLEM 1
         "*** YOUR CODE HERE ***"
-        if src.current() == ')':
-            src.pop_first()
-            return nil
-        else:
-            return Pair(scheme_read(src), read_tail(src))
+        values = []
+        while True:
+            if src.current() is None:
+                raise SyntaxError('unexpected end of file')
+            if src.current() == ')':
+                src.pop_first()
+                return Pair.from_iterable(values)
+            values.append(scheme_read(src))
         # END PROBLEM 1
     except EOFError:
         raise SyntaxError('unexpected end of file')
@@ -178,6 +486,33 @@ def buffer_lines(lines, prompt='scm> ', show_prompt=False):
         input_lines = LineReader(lines, prompt)
     return Buffer(tokenize_lines(input_lines))
 
+def buffer_file(infile, prompt='scm> '):
+    """Return a Buffer instance iterating through the lines of the open file
+    INFILE, which are read only as they are needed. Each line is echoed after
+    PROMPT unless PROMPT is None."""
+    return Buffer(tokenize_lines(FileReader(infile, prompt)))
+
+class FileReader(object):
+    """An iterable over the lines of an open file, like the LineReader that
+    buffer_lines uses for a list of lines. Lines are pulled from the file as
+    they are iterated over, so a file need not be read into memory before
+    its first expression can be evaluated."""
+
+    def __init__(self, infile, prompt, comment=';'):
+        self.infile = infile
+        self.prompt = prompt
+        self.comment = comment
+
+    def __iter__(self):
+        for line in self.infile:
+            line = line.rstrip('\n')
+            if (self.prompt is not None and line != '' and
+                    not line.lstrip().startswith(self.comment)):
+                print(self.prompt + line)
+                self.prompt = ' ' * len(self.prompt)
+            yield line
+        raise EOFError
+
 def read_line(line):
     """Read a single string LINE as a Scheme expression."""
     return scheme_read(Buffer(tokenize_lines([line])))
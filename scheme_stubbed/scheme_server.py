@@ -0,0 +1,338 @@
+"""A server that evaluates Scheme expressions sent to it over a Unix socket.
+
+Each connection is a session with its own global frame, into which the
+library files named with --load have already been loaded, so a request pays
+only for evaluating its own expressions. Start a server, and then talk to it
+with the stand-in client:
+
+    python3 scheme_server.py --socket /tmp/scheme.sock --load lib.scm
+    python3 scheme_server.py --socket /tmp/scheme.sock --client
+
+The protocol is one JSON object per line in each direction. A request is
+
+    {"id": 1, "source": "(define x 2) (* x 3)"}
+
+and its response is
+
+    {"id": 1, "values": ["x", "6"], "output": "", "error": null}
+
+VALUES are the results of the expressions in SOURCE, as the read-eval-print
+loop would print them; OUTPUT is what they printed, along with the errors
+the loop would print; ERROR is the message of the first error, if any. A
+session ends when the client closes the connection or evaluates (exit).
+
+Each session runs in a process of its own, so a request that takes long, or
+never finishes, holds up only the client that sent it, and what a request
+prints is captured in its own process.
+"""
+
+import asyncio
+import io
+import json
+import multiprocessing
+import os
+import socket
+import sys
+from contextlib import redirect_stdout
+
+import scheme
+from scheme import (SchemeError, analyze_eval, buffer_lines,
+                    create_global_frame, read_eval_print_loop, repl_str,
+                    scheme_eval, scheme_load, scheme_read, vm_eval)
+from ucb import main
+
+
+class Session(object):
+    """A global frame with LOAD_FILES loaded into it, in which requests are
+    evaluated by EVALUATE."""
+
+    def __init__(self, load_files=(), evaluate=scheme_eval):
+        self.env = create_global_frame()
+        self.evaluate = evaluate
+        self.closed = False
+        with redirect_stdout(io.StringIO()):
+            for filename in load_files:
+                scheme_load(filename, True, self.env, evaluate=evaluate)
+
+    def eval(self, source):
+        """Evaluate the expressions in the string SOURCE and return a dict
+        of their values, their output and the first error, if any."""
+        values, errors = [], []
+        def evaluate(expression, env):
+            try:
+                result = self.evaluate(expression, env)
+            except EOFError:  # (exit)
+                self.closed = True
+                raise
+            except (SchemeError, RuntimeError) as err:
+                errors.append(err)
+                raise
+            if result is not None:
+                values.append(repl_str(result))
+        def read(src):
+            try:
+                return scheme_read(src)
+            except (SyntaxError, ValueError) as err:
+                errors.append(err)
+                raise
+
+        lines = source.splitlines()
+        output = io.StringIO()
+        with redirect_stdout(output):
+            try:
+                read_eval_print_loop(lambda: buffer_lines(lines, None), self.env,
+                                     quiet=True, evaluate=evaluate, read=read)
+            except RuntimeError as err:  # Re-raised by print_error
+                print('Error:', err)
+                print()
+        output = output.getvalue()[:-1]  # The newline printed at the end
+        error = None
+        if errors:
+            error = str(errors[0])
+            if isinstance(errors[0], RecursionError):
+                error = 'maximum recursion depth exceeded'
+        return {'values': values, 'output': output, 'error': error}
+
+
+def session_main(connection, load_files, evaluate):
+    """Serve a Session made with LOAD_FILES and EVALUATE over CONNECTION, one
+    end of a Pipe. Each source received is answered with its response and
+    whether the session has closed."""
+    scheme.EVALUATE = evaluate  # For loads made by the requests
+    session = Session(load_files, evaluate)
+    while not session.closed:
+        try:
+            source = connection.recv()
+        except EOFError:
+            return
+        try:
+            response = session.eval(source)
+        except Exception as exc:
+            response = {'values': [], 'output': '',
+                        'error': 'internal error: {0}'.format(exc)}
+        connection.send((response, session.closed))
+
+
+class SessionProcess(object):
+    """A Session made with LOAD_FILES and EVALUATE in a process of its own.
+    The process loads the files as soon as it starts."""
+
+    def __init__(self, load_files=(), evaluate=scheme_eval):
+        context = multiprocessing.get_context('spawn')
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=session_main, daemon=True,
+                                       args=(child, load_files, evaluate))
+        self.process.start()
+        child.close()
+        self.closed = False
+
+    async def eval(self, source):
+        """Evaluate SOURCE in the session and return its response, waiting
+        for the process without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        fd = self.connection.fileno()
+        self.connection.send(source)
+        loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            loop.remove_reader(fd)
+        try:
+            response, self.closed = self.connection.recv()
+        except EOFError:
+            self.closed = True
+            response = {'values': [], 'output': '',
+                        'error': 'the session ended unexpectedly'}
+        return response
+
+    def close(self):
+        """End the session, stopping anything it is evaluating."""
+        self.closed = True
+        self.connection.close()
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+
+
+class SchemeServer(object):
+    """Serves Sessions made with LOAD_FILES and EVALUATE on the Unix socket
+    at PATH, each in a SessionProcess. A session is started before it is
+    needed, after the previous one is taken, so that connecting does not
+    wait for the libraries to load."""
+
+    def __init__(self, path, load_files=(), evaluate=scheme_eval):
+        self.path = path
+        self.load_files = load_files
+        self.evaluate = evaluate
+        self.spare = None
+
+    def make_session(self):
+        return SessionProcess(self.load_files, self.evaluate)
+
+    def prepare(self):
+        if self.spare is None:
+            self.spare = self.make_session()
+
+    def take_session(self):
+        session, self.spare = self.spare or self.make_session(), None
+        asyncio.get_running_loop().call_soon(self.prepare)
+        return session
+
+    async def handle(self, reader, writer):
+        # The next line is read while a request is evaluated, so that the
+        # session is ended if the client goes away before it finishes.
+        session = self.take_session()
+        following = asyncio.ensure_future(reader.readline())
+        response = None
+        try:
+            while not session.closed:
+                line = await following
+                if not line:
+                    break
+                response = asyncio.ensure_future(self.respond(session, line))
+                following = asyncio.ensure_future(reader.readline())
+                await asyncio.wait([response, following],
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if not response.done() and not following.result():
+                    break
+                writer.write(await response)
+                await writer.drain()
+        finally:
+            for task in (response, following):
+                if task is not None:
+                    task.cancel()
+            writer.close()
+            session.close()
+
+    async def respond(self, session, line):
+        """Return the encoded response of SESSION to the request LINE."""
+        try:
+            request = json.loads(line.decode('utf-8'))
+            source = request['source']
+            if not isinstance(source, str):
+                raise TypeError('source is not a string')
+        except (ValueError, KeyError, TypeError) as exc:
+            response = {'values': [], 'output': '',
+                        'error': 'bad request: {0}'.format(exc)}
+            request = {}
+        else:
+            response = await session.eval(source)
+        if isinstance(request, dict) and 'id' in request:
+            response['id'] = request['id']
+        return (json.dumps(response) + '\n').encode('utf-8')
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # Left by a server that did not exit cleanly
+        self.prepare()
+        server = await asyncio.start_unix_server(self.handle, self.path)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if self.spare is not None:
+                self.spare.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+class Client(object):
+    """A blocking client of the server at PATH, for tests and scripts.
+
+    >>> import tempfile, threading, time
+    >>> path = os.path.join(tempfile.mkdtemp(), 'scheme.sock')
+    >>> thread = threading.Thread(target=asyncio.run, daemon=True,
+    ...                           args=(SchemeServer(path).serve(),))
+    >>> thread.start()
+    >>> while not os.path.exists(path):
+    ...     time.sleep(0.01)
+    >>> with Client(path) as client:
+    ...     client.eval('(define (square x) (* x x)) (square 4)')['values']
+    ...     client.eval('(print (square 5)) (car nil)')
+    ['square', '16']
+    {'values': [], 'output': '25\\nError: argument 0 of car has wrong type (nil)\\n', 'error': 'argument 0 of car has wrong type (nil)', 'id': 2}
+    >>> with Client(path) as client:  # A new session
+    ...     client.eval('square')['error']
+    'name "square" was not defined'
+    """
+
+    def __init__(self, path):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.file = self.socket.makefile('rwb')
+        self.count = 0
+
+    def eval(self, source):
+        """Send SOURCE to be evaluated and return the response as a dict."""
+        self.count += 1
+        request = {'id': self.count, 'source': source}
+        try:
+            self.file.write((json.dumps(request) + '\n').encode('utf-8'))
+            self.file.flush()
+            line = self.file.readline()
+        except ConnectionError:
+            line = None
+        if not line:
+            raise EOFError('the server closed the session')
+        return json.loads(line.decode('utf-8'))
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def client_loop(path):
+    """Send each line read from standard input to the server at PATH and
+    print the response as the read-eval-print loop would."""
+    with Client(path) as client:
+        while True:
+            try:
+                line = input('scm> ')
+            except EOFError:
+                print()
+                return
+            try:
+                response = client.eval(line)
+            except EOFError:
+                return
+            sys.stdout.write(response['output'])
+            for value in response['values']:
+                print(value)
+
+
+@main
+def run(*argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='CS 61A Scheme evaluation server')
+    parser.add_argument('--socket', metavar='PATH', required=True,
+                        help='the Unix socket to listen on, or to connect to')
+    parser.add_argument('--load', metavar='FILE', action='append', default=[],
+                        help='a library file to load into each session')
+    parser.add_argument('--analyze', action='store_true',
+                        help='evaluate requests in analyze mode')
+    parser.add_argument('--vm', action='store_true',
+                        help='evaluate requests on the bytecode virtual machine')
+    parser.add_argument('--client', action='store_true',
+                        help='connect to a running server and evaluate standard input')
+    args = parser.parse_args()
+
+    sys.path.insert(0, '')
+    if args.client:
+        return client_loop(args.socket)
+    if args.vm:
+        evaluate = vm_eval
+    elif args.analyze:
+        evaluate = analyze_eval
+    else:
+        evaluate = scheme_eval
+    try:
+        asyncio.run(SchemeServer(args.socket, args.load, evaluate).serve())
+    except KeyboardInterrupt:
+        pass